@@ -16,7 +16,10 @@ The script contains the following primary functions:
         for each calender year. The cumulative of the variable is then smoothed. Taking the differentiation of smoothed 
         cumulative value the smoothed value of Var is then obtained. Spline function is used for smoothing. 
         spline is a piecewise regression, thereby it is sensitive to the number of knots, provided by the user. 
-        Usually, knots for an annual time series can vary from 8 to 15.
+        Usually, knots for an annual time series can vary from 8 to 15. The spline fit of all years at once with a
+        cached projection matrix ('projection') and the faster backends 'whittaker', 'savgol' and 'harmonic' can be
+        used instead of the spline fitted to each year. With padding=None the whole record is smoothed in one
+        fit instead of padded years, for the spline with knots in every year and a banded solver.
 
 
      2. direct_smoothing(df,knots): Smooths the daily value of GPP using the traditional smoothing method.
@@ -35,7 +38,46 @@ The script contains the following primary functions:
        The first dataframe contains columns "Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der" and "GSL_der".
        Here 'der' refers to PTDs calculated using derivative method, The second dataframe output is the smoothed value
        of dataframe using integral smoothing. Less than 0 values indicate days in the previous years and more than 365 value
-       indicates days in the next year. See the function for more information.
+       indicates days in the next year. See the function for more information. The missing values are filled linearly or
+       from the climatology of the site (gap_fill) and quality=True adds quality flags of the gaps of each year.
+
+     4. EasyPhenology_batch(df, Threshold_value, Smoothing, knots, site, time): Same as EasyPhenology but for many sites
+       or pixels in one call. The input is a long-format dataframe with columns site, 'time', 'year', 'doy' and 'Var',
+       or a 2-D array of sites x days with the dates in time. The smoothing windows of all sites are smoothed together
+       and the outputs are df_pheno_out and df_smooth of all sites with an additional site column.
+
+     5. PhenologyStream(Threshold_value, Smoothing, knots): EasyPhenology for a site that receives new daily values.
+       New days are added with update(df) and only the years that depend on them are smoothed and processed again.
+       df_pheno_out and df_smooth are the same as EasyPhenology on all days received so far, provisional gives the
+       provisional SOS, POS and EOS of the current, incomplete year.
+
+     6. EasyPhenology_grid(cube, time, Threshold_value, Smoothing, knots, out_dir): PTD rasters for gridded data larger than
+       memory, for example satellite GPP or LAI with shape (days, lat, lon) in a memory-mapped .npy file or a zarr array.
+       The cube is processed one spatial tile at a time and the PTDs are written to memory-mapped files in out_dir.
+       An interrupted run continues with the tiles that are not finished.
+
+     7. EasyPhenology_uncertainty(df, Threshold_value, Smoothing, knots, n_replicates): percentile intervals of the PTDs
+       of each year for the threshold and derivative methods, from replicates of Var made by resampling the residuals
+       of the smoothing (or adding noise). All replicates are smoothed and processed together.
+
+     8. PhenologyStore(path): on-disk store of the results of EasyPhenology_batch(..., store=store), compact .npy columns
+       for each site and content hash of its input and parameters. Sites with unchanged input are read from the store,
+       memory-mapped, instead of being computed again.
+
+     9. PhenologyProfile(memory): opt-in instrumentation. In a with block every stage of the functions above records its
+       calls, wall time and peak allocated memory, the steps done for each site separately also by site, and the PTD
+       kernel records the CASE 1 to 4 of each site and year. The results can be written to JSON, CSV or folded stacks
+       for a flame graph.
+
+    10. daily_aggregate(source, time, Var): aggregates sub-daily values, for example half-hourly GPP in a CSV or .npy file,
+       to the daily columns 'time', 'year', 'doy' and 'Var' with the number of valid (n) and missing (gaps) values of each
+       day. The file is read in chunks, so the memory does not grow with the length of the record. Days with too few
+       valid values are nan and count as missing days of their year.
+
+    11. EasyPhenology_seasons(df, Threshold_value, Smoothing, knots): PTDs of every growing season, for example of double
+       cropping. All peaks with a prominence of at least a fraction of the amplitude of their year are seasons, each with
+       the threshold and derivative SOS and EOS on its own rise and fall. One row per season with its number in the year.
+
 
 Links:
 Gitlab: https://git.bgc-jena.mpg.de/apanwar/phenofeedbacks.git
@@ -49,24 +91,65 @@ Annu Panwar: apanwar@bgc-jena.mpg.de
 
 
 #import required libraries
+#scipy.signal is slow to import, it is imported in _derivative_rows when PTDs are computed
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import shutil
+import time
+import tracemalloc
+import types
+import urllib.parse
+import warnings
+from multiprocessing import shared_memory
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
-from scipy.stats import linregress
-from scipy import stats
-from scipy import signal
-from scipy.signal import argrelextrema
-import warnings
-pd.options.mode.chained_assignment = None  # default='warn'
-warnings.filterwarnings("ignore")
-warnings.simplefilter("ignore")
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore", category=RuntimeWarning)
 
-from tsmoothie.smoother import *
+
+#Instrumentation, see PhenologyProfile. When no profile is active the stages cost one check of _profiler
+_profiler=None
+_no_stage=contextlib.nullcontext()
+
+
+def _stage(name, site=None):
+
+    '''
+
+    Context manager that records the time, calls and memory of a stage in the active PhenologyProfile
+
+    '''
+
+    if _profiler is None:
+        return _no_stage
+
+    return _profiler._stage(name, site)
+
+
+
+def _staged(function):
+
+    '''
+
+    Decorator that records a function as a stage of the active PhenologyProfile
+
+    '''
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _profiler is None:
+            return function(*args, **kwargs)
+        with _profiler._stage(function.__name__.strip('_'), None):
+            return function(*args, **kwargs)
+
+    return wrapper
+
 
 
-def integral_smoothing(df, knots):
+@_staged
+def integral_smoothing(df, knots, backend='spline', padding=20, gap_fill='linear', max_missing=50):
 
     '''
 
@@ -83,407 +166,3265 @@ def integral_smoothing(df, knots):
     Parameters
     ----------
     df : a dataframe with columns : time, year, doy, Var. Var is the variable of interest
+    knots : number of knots of the spline, recommended 8 to 15, or "auto" to choose it from 8 to 15 by generalized cross-validation
+    backend : 'spline' fits the natural cubic spline to each year with the same least squares regression as
+              tsmoothie's SplineSmoother, so the results are the same as with tsmoothie. 'projection' smooths all
+              years at once with the precomputed projection matrix of the spline, which is faster and gives the same
+              fit up to floating point rounding; where the smoothed curve is flat the day of a maximum can differ.
+              'whittaker' (Whittaker smoother with a banded solver), 'savgol' (Savitzky-Golay filter) and 'harmonic'
+              (FFT harmonic fit) are faster alternatives whose smoothness is set from knots so that they keep the
+              same periods as the spline with knots in a year. A function backend(Var_stack, knots, integral) that
+              smooths the rows of an array of windows x days can also be given.
+    padding : number of days of the previous and next year added to each year for the smoothing, 20 by default.
+              The days of a year are laid out by doy, so a leap year keeps its day 366 and a partial first or
+              last year keeps its own days. Days without a row are interpolated like nan values.
+              None smooths the whole record in one window instead of padded years, with the cumulative taken
+              once over the record. With 'spline' one cubic B-spline with knots in every year is fitted with a
+              banded solver, so the cost is linear in the length of the record and the smoothed values and their
+              derivative are continuous at the new year, also with 'projection'. A year with 50 or more missing
+              values splits the record
+    gap_fill : 'linear' interpolates the missing values linearly. 'climatology' fills them with the mean of all
+               years at the same doy plus the linearly interpolated difference to this mean, so that long gaps
+               follow the mean seasonal cycle. The gaps of all years are filled at once
+    max_missing : years with this number of missing values or more are not smoothed, 50 by default
+
+    Returns
+    -------
+    df_smooth : the dataframe with columns time,year, doy and Var, where Var is the smoothed values.
+                The number of knots used is in df_smooth.attrs['knots']
+
+    '''
+
+    return _smooth_frame(df, knots, True, backend, padding, gap_fill, max_missing)[0]
+
+
+
+
+
+
+@_staged
+def direct_smoothing(df,knots, backend='spline', padding=20, gap_fill='linear', max_missing=50):
+
+    '''
+
+        Smooths the daily value of GPP using the traditional smoothing method.
+        This function requires dataframe with columns 'time', 'year', 'doy' and 'Var', in the given order.
+        This functions smooths variable Var, in this case GPP. The first step is to interpolate the missing value.
+        Then the smoothing of daily GPP signal is done for each calender month. Spline function is used for smoothing. 
+
+
+     Parameters
+     ----------
+        df : a dataframe with columns : time, year, doy, Var. Var is the variable of interest
+        knots : number of knots of the spline, recommended 8 to 15, or "auto" to choose it from 8 to 15 by generalized cross-validation
+        backend : 'spline', 'projection', 'whittaker', 'savgol', 'harmonic' or a function, see integral_smoothing
+        padding : days added before and after each year for the smoothing, or None for the whole record, see integral_smoothing
+        gap_fill : 'linear' or 'climatology', see integral_smoothing
+        max_missing : years with this number of missing values or more are not smoothed, 50 by default
+
+     Returns
+        -------
+        df_smooth : the dataframe with columns time,year, doy and Var, where Var is the smoothed values
+
+    '''
+
+    return _smooth_frame(df, knots, False, backend, padding, gap_fill, max_missing)[0]
+
+
+
+
+
+
+
+
+@_staged
+def EasyPhenology(df, Threshold_value, Smoothing,knots, backend='spline', padding=20, gap_fill='linear', max_missing=50,
+                  quality=False):
+
+    '''
+
+    Produces phenological transition dates (PTDs) for the given dataframe
+
+    This function requires dataframe with columns 'time', 'year', 'doy' and 'Var'. These values
+    should be in daily time scale. This function first smooths Var using integral smoothing and
+    then the PTDs are produced.
+    The Threshold_value is the fixed percentage of the annual maximum GPP and can vary from 0 to 1. 
+    It can also be a sequence of thresholds, for example np.arange(0.1, 0.95, 0.05) for a sensitivity
+    analysis. The smoothing and the derivative curves are then computed once and df_pheno_out has a
+    column "Threshold" with the PTDs of every threshold.
+    If smoothing='True', integral smoothing is used,
+    if smoothing='False', then the direct smoothing method is used. 
+    The backend of the smoothing can be 'spline', 'projection', 'whittaker', 'savgol', 'harmonic' or a
+    function, see integral_smoothing.
+    With knots="auto" the number of knots is chosen from 8 to 15 by generalized cross-validation and
+    df_pheno_out has a column "knots" with the chosen number.
+    padding is the number of days of the previous and next year used in the smoothing of a year, see
+    integral_smoothing. The days of each year are laid out by doy, 366 in leap years, and days without a
+    row count as missing values. padding=None smooths the whole record in one fit, with knots in every
+    year for the spline.
+    gap_fill ('linear' or 'climatology') sets how the missing values are filled before the smoothing and
+    max_missing the number of missing values from which a year is not smoothed (50), see integral_smoothing.
+    Such years have nan PTDs, also with the raw Var.
+    With quality=True df_pheno_out has the quality flags of the gaps of each year: "missing_days",
+    "longest_gap" and "gap_SOS", "gap_EOS", True if a missing day is within 5 days of SOS or EOS.
+
+    The outputs are two dataframes df_pheno_out and df_smooth.
+    The first dataframe contains columns "Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der" and "GSL_der".
+    Here 'der' refers to PTDs calculated using derivative method, The second dataframe output is the smoothed value
+    of dataframe using integral smoothing. Less than 0 values indicate days in the previous years and more than 365 value
+    (366 in leap years) indicates days in the next year. See the function for more information.
 
     Returns
     -------
+    df_pheno_out: the dataframe with columns "Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der",
+                  and "Threshold" before "Year" for a sequence of thresholds
     df_smooth : the dataframe with columns time,year, doy and Var, where Var is the smoothed values
+    '''
+
+
+    #Smooth Var using integral smoothing (True) or direct smoothing (False). The PTDs are computed from the
+    #smoothed values of all days of the years, also of the days without a row in df
+    year_raw, doy_raw, Var_raw=df['year'].to_numpy(), df['doy'].to_numpy(), df['Var'].to_numpy(dtype=float)
+    if Smoothing in ("True", "False"):
+        df, (year, doy, Var)=_smooth_frame(df, knots, Smoothing == "True", backend, padding, gap_fill, max_missing)
+
+    #Take the raw Var
+    else:
+        year, doy, Var=year_raw, doy_raw, Var_raw
+
+    #PTDs of all years, stored in a preallocated array
+    Var_Years, ptd=_phenology_site(year, doy, Var, Threshold_value, max_missing=max_missing)
+
+    #The dataframe with PTDs [ output 1], built once with the order sos,pos,eos corrected for all years
+    df_pheno_out=_phenology_frame(Var_Years, ptd, Threshold_value=Threshold_value)
+
+    #Report the number of knots chosen by generalized cross-validation
+    if knots == "auto" and Smoothing in ("True", "False"):
+        df_pheno_out['knots']=df.attrs['knots']
+
+    #Quality flags of the gaps of each year
+    if quality:
+        flags=_gap_flags(year_raw, doy_raw, Var_raw, df_pheno_out['Year'].to_numpy(), df_pheno_out['SOS'], df_pheno_out['EOS'])
+        for column, values in flags.items():
+            df_pheno_out[column]=values
+
+    #The dataframe with smoothed Var [ output 2]
+    df_smooth=df
+
+    return df_pheno_out, df_smooth
+
+
+
+
+#Array routines for smoothing and PTDs
+#
+#The functions below run the smoothing and PTD extraction of integral_smoothing,
+#direct_smoothing and EasyPhenology on numpy arrays. The padded yearly windows of all
+#years (and of all sites in EasyPhenology_batch) are collected first and smoothed together.
+
+
+def _year_index(year):
 
     '''
 
-    # Create empty list for Var_smooth
-    Var_smooth=[]
+    Preprocessing stage of the year loops: sorts the rows by year once and gives the offsets of each year
 
-    # Create empty dataframe for smoothed values of Variable Var
-    df_smooth=pd.DataFrame()
+    After sorting, the rows of year Var_Years[j] are the slice starts[j]:stops[j], so the current, previous
+    and next year are found without searching the year column. If the rows are already sorted by year,
+    as for a daily time series, nothing is reordered and the years are slices of the original arrays.
 
-    # Total number of years in the site
-    Var_Years=np.unique(df['year'])
+    Parameters
+    ----------
+    year : array with the year of every row
 
-    for j, element in enumerate(Var_Years):  # Loop for each year
-        df_jyear=df.loc[df['year'] ==Var_Years[j]] #the dataframe for year j
+    Returns
+    -------
+    order : row positions that sort the rows by year, the order of rows within a year is kept.
+            None if the rows are already sorted
+    Var_Years : sorted unique years
+    starts, stops : offsets of each year in the sorted rows
 
-        #Loop only if year has nan values for less than 50 days
-        if df_jyear['Var'].isnull().sum()<50:
+    '''
 
-            # If it is not the first year (j>0) then also get the points where the threshold line crosses the previous year
-            if j>0:
-                df_jyear_p=df.loc[df['year'] ==Var_Years[j-1]] #the dataframe for year j-1
+    year=np.asarray(year)
 
-            # If it is not the last year (j<len(Var_Years)-1) then also get the points where the threshold line crosses the next year
-            if j<len(Var_Years)-1:
-                df_jyear_n=df.loc[df['year'] ==Var_Years[j+1]] #the dataframe for year j+1
+    #sort only if needed
+    order=None
+    if (year[1:]<year[:-1]).any():
+        order=np.argsort(year, kind='stable')
+        year=year[order]
 
-            #For smoothing add 20 days before and after the year from the same year end points
-            if j>0:
-                df_jyear_b= df_jyear_p.tail(20)
-            else:
-                df_jyear_b= df_jyear.head(20)
+    starts=np.flatnonzero(np.r_[True, year[1:]!=year[:-1]]) if len(year) else np.array([], dtype=int)
+    stops=np.r_[starts[1:], len(year)].astype(int)
 
-            if j<len(Var_Years)-1:
-                df_jyear_a= df_jyear_n.head(20)
-            else:
-                df_jyear_a= df_jyear.tail(20)
+    return order, year[starts], starts, stops
 
 
-            df_jyear=pd.concat([df_jyear_b, df_jyear, df_jyear_a ])
 
-            #interpolate if there are some nan
-            df_jyear['Var']=df_jyear['Var'].interpolate(method='linear')
+def _year_rows(order, start, stop):
 
-            # Calculate Cumulative of Variable from raw Var values
-            Var_cum = df_jyear['Var'].cumsum()
+    '''
 
-            #Smooth the cumulative signal with savgol
-            #Cumulative curve is already quite smooth using different smoothing method can be tested
-            #Var_cum_smooth= signal.savgol_filter(Var_cum, window_length=201, polyorder=3, mode="nearest")
-            #Var_smooth=np.gradient(Var_cum_smooth,1)
+    Rows of one year from the year index, a slice (no copy of the data) if the rows are already sorted
 
+    '''
 
-            #smooth the signal with spline
-            smoother = SplineSmoother(n_knots=knots, spline_type='natural_cubic_spline')
-            smoother.smooth(Var_cum)
-            Var_cum_smooth=smoother.smooth_data[0]
+    if order is None:
+        return slice(start, stop)
 
+    return order[start:stop]
 
-            #Take the differentiation of the smoothed cumulative values
-            Var_smooth=np.gradient(Var_cum_smooth,1)
-            df_jyear['Var']=Var_smooth
 
-            #Remove extra 10 days before and after the yearly values
-            df_jyear=df_jyear.iloc[20:385,:]
 
-            #Store the smoothed values for each year
-            df_smooth = pd.concat([df_smooth, df_jyear])
+def _year_grid(year, doy):
 
-        else:
+    '''
+
+    Dense layout of the rows: one row of 366 days for each year, with the row position of each day
+
+    Parameters
+    ----------
+    year : array with the year of every row (or another integer key, for example of site and year)
+    doy : array with the day of year of every row, from 1 to 366
 
-            # if year has nan values for more than 50 days return all nan
-            df_jyear["Var"]=np.nan
+    Returns
+    -------
+    Var_Years : sorted unique years
+    index : array of shape (years, 366), index[j, d-1] is the row position of day d of year Var_Years[j],
+            -1 (the validity mask is index>=0) if there is no row for this day
+
+    '''
 
-            #Store nan values for years with more than 50 days of nan values
-            df_smooth = pd.concat([df_smooth, df_jyear])
+    order, Var_Years, starts, stops=_year_index(year)
+    rows=np.arange(len(year)) if order is None else order
 
-    return df_smooth
+    day=np.asarray(doy)[rows]-1
+    if len(day) and (day.min()<0 or day.max()>365):
+        raise ValueError("doy must be from 1 to 366")
 
+    index=np.full((len(Var_Years), 366), -1)
+    index[np.repeat(np.arange(len(Var_Years)), stops-starts), day]=rows
 
+    if (index>=0).sum()<len(rows):
+        raise ValueError("a year has more than one row for the same doy")
 
+    return Var_Years, index
 
 
 
-def direct_smoothing(df,knots):
+def _window_values(Var, window):
 
     '''
 
-        Smooths the daily value of GPP using the traditional smoothing method.
-        This function requires dataframe with columns 'time', 'year', 'doy' and 'Var', in the given order.
-        This functions smooths variable Var, in this case GPP. The first step is to interpolate the missing value.
-        Then the smoothing of daily GPP signal is done for each calender month. Spline function is used for smoothing. 
+    Values of Var at the row positions of a smoothing window, nan for the days without a row (-1)
 
+    '''
+
+    return np.where(window>=0, Var[window], np.nan)
 
-     Parameters
-     ----------
-        df : a dataframe with columns : time, year, doy, Var. Var is the variable of interest
 
-     Returns
-        -------
-        df_smooth : the dataframe with columns time,year, doy and Var, where Var is the smoothed values
+
+def _span_days(rows, year, doy):
 
     '''
 
-    # Create empty list for Var_smooth
-    Var_smooth=[]
+    Year and doy of the days of the smoothed output of _smoothing_windows, also of the days without a row
 
-    # Create empty dataframe for smoothed values of Variable Var
-    df_smooth=pd.DataFrame()
+    '''
 
-    # Total number of years in the site
-    Var_Years=np.unique(df['year'])
+    if not rows:
+        return np.array([], dtype=int), np.array([], dtype=int)
 
-    for j, element in enumerate(Var_Years):  # Loop for each year
-        df_jyear=df.loc[df['year'] ==Var_Years[j]] #the dataframe for year j
+    first=np.array([r[0] for r in rows])
 
-        #Loop only if year has nan values for less than 50 days
-        if df_jyear['Var'].isnull().sum()<50:
+    return np.repeat(year[first], [len(r) for r in rows]), np.concatenate([doy[r[0]] + np.arange(len(r)) for r in rows])
 
-            # If it is not the first year (j>0) then also get the points where the threshold line crosses the previous year
-            if j>0:
-                df_jyear_p=df.loc[df['year'] ==Var_Years[j-1]] #the dataframe for year j-1
 
-            # If it is not the last year (j<len(Var_Years)-1) then also get the points where the threshold line crosses the next year
-            if j<len(Var_Years)-1:
-                df_jyear_n=df.loc[df['year'] ==Var_Years[j+1]] #the dataframe for year j+1
 
-            #For smoothing add 20 days before and after the year from the same year end points
-            if j>0:
-                df_jyear_b= df_jyear_p.tail(20)
-            else:
-                df_jyear_b= df_jyear.head(20)
+def _fill_gaps(Var_stack, climatology=None):
 
-            if j<len(Var_Years)-1:
-                df_jyear_a= df_jyear_n.head(20)
-            else:
-                df_jyear_a= df_jyear.tail(20)
+    '''
+
+    Gap-fill stage, fills the nan values of all rows of Var_stack (windows x days) at once
 
+    Without climatology the nan values are interpolated linearly between the valid values, as
+    pandas interpolate(method='linear'): leading nan values are kept and trailing nan values take the
+    last valid value. With climatology (an array of the same shape with the mean of all years at the
+    doy of each day) the anomalies from the climatology are interpolated linearly and the climatology
+    is added back, so a long gap follows the mean seasonal cycle. Leading anomalies take the first
+    valid anomaly, so rows with a gap at the start are filled as well.
 
-            df_jyear=pd.concat([df_jyear_b, df_jyear, df_jyear_a ])
+    '''
 
-            #interpolate if there are some nan
-            df_jyear['Var']=df_jyear['Var'].interpolate(method='linear')
+    if climatology is not None:
+        Var_stack=Var_stack-climatology
 
-            # Calculate Cumulative of Variable from raw Var values
-            Var_cum = df_jyear['Var'].cumsum()
+    nan=np.isnan(Var_stack)
+    if nan.any():
+        n_days=Var_stack.shape[1]
+        position=np.arange(n_days)
+        row=np.arange(len(Var_stack))[:, None]
 
-            #Smooth the cumulative signal
-            #Cumulative curve is already quite smooth using different smoothing method can be tested
-            #Var_cum_smooth= signal.savgol_filter(Var_cum, window_length=201, polyorder=3, mode="nearest")
-            #Var_smooth=signal.savgol_filter(df_jyear['Var'], window_length=201, polyorder=3, mode="nearest")
+        #the previous and the next valid day of every day, -1 and n_days if there is none
+        before=np.maximum.accumulate(np.where(nan, -1, position), axis=1)
+        after=np.minimum.accumulate(np.where(nan, n_days, position)[:, ::-1], axis=1)[:, ::-1]
+        Var_before=Var_stack[row, np.maximum(before, 0)]
+        Var_after=Var_stack[row, np.minimum(after, n_days-1)]
 
-            #smooth the signal with spline
-            smoother = SplineSmoother(n_knots=knots, spline_type='natural_cubic_spline')
-            smoother.smooth(df_jyear['Var'])
-            Var_smooth=smoother.smooth_data[0]
+        #interpolation with the same operations as np.interp
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope=(Var_after-Var_before)/(after-before)
+            inside=slope*(position-before)+Var_before
 
-            #Take the differentiation of the smoothed cumulative values
-            #Var_smooth=np.gradient(Var_cum_smooth,1)
-            df_jyear['Var']=Var_smooth
+        leading=Var_after if climatology is not None else np.nan
+        Var_stack=np.where(~nan, Var_stack, np.where(before<0, leading, np.where(after>=n_days, Var_before, inside)))
 
-            #Remove extra 10 days before and after the yearly values
-            df_jyear=df_jyear.iloc[20:385,:]
+    if climatology is not None:
+        Var_stack=Var_stack+climatology
 
-            #Store the smoothed values for each year
-            df_smooth = pd.concat([df_smooth, df_jyear])
+    return Var_stack
 
-        else:
 
-            # if year has nan values for more than 50 days return all nan
-            df_jyear["Var"]=np.nan
 
-            #Store nan values for years with more than 50 days of nan values
-            df_smooth = pd.concat([df_smooth, df_jyear])
+def _segment_positions(start, length):
 
-    return df_smooth
+    '''
+
+    Concatenated ranges start[i]:start[i]+length[i] of all segments, without a loop over the segments
 
+    '''
 
+    start=np.asarray(start, dtype=int)
+    length=np.asarray(length, dtype=int)
+    offset=np.cumsum(length)-length
 
+    return np.repeat(start-offset, length) + np.arange(length.sum())
 
 
 
+def _split(values, length):
 
+    '''
 
-def EasyPhenology(df, Threshold_value, Smoothing,knots):
+    List of consecutive pieces of values with the given lengths, views of values
 
     '''
 
-    Produces phenological transition dates (PTDs) for the given dataframe
+    return np.split(values, np.cumsum(length)[:-1]) if len(length) else []
 
-    This function requires dataframe with columns 'time', 'year', 'doy' and 'Var'. These values
-    should be in daily time scale. This function first smooths Var using integral smoothing and
-    then the PTDs are produced.
-    The Threshold_value is the fixed percentage of the annual maximum GPP and can vary from 0 to 1. 
-    If smoothing='True', integral smoothing is used,
-    if smoothing='False', then the direct smoothing method is used. 
 
-    The outputs are two dataframes df_pheno_out and df_smooth.
-    The first dataframe contains columns "Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der" and "GSL_der".
-    Here 'der' refers to PTDs calculated using derivative method, The second dataframe output is the smoothed value
-    of dataframe using integral smoothing. Less than 0 values indicate days in the previous years and more than 365 value
-    indicates days in the next year. See the function for more information.
+
+@_staged
+def _smoothing_windows(year, doy, Var, padding=20, gap_fill='linear', max_missing=50):
+
+    '''
+
+    Padded smoothing windows of one site, as used by integral_smoothing and direct_smoothing
+
+    The rows are laid out by day of year with _year_grid. A year spans the days from its first to its
+    last row, 366 days in a complete leap year. The days without a row in this span are missing values,
+    they are filled and smoothed like nan values. Every year is padded with the last days of the
+    previous year and the first days of the next year (or with its own first and last days for the first
+    and last year). Years with max_missing (50) or more missing values are not smoothed.
+
+    With padding None the whole record is one window: the consecutive years that are smoothed are joined,
+    with the days without a row between them, and a year that is not smoothed splits the record.
+
+    Parameters
+    ----------
+    year : array with the year of every row
+    doy : array with the day of year of every row
+    Var : array with the values of Var
+    padding : number of days added before and after each year, or None for whole-record windows
+    gap_fill : 'linear' or 'climatology', see _fill_gaps
+    max_missing : years with this number of missing values or more are not smoothed
 
     Returns
     -------
-    df_pheno_out: the dataframe with columns "Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der"
-    df_smooth : the dataframe with columns time,year, doy and Var, where Var is the smoothed values
+    windows : list with the row positions of the padded window of every year that is smoothed (of every
+              run of consecutive years for padding None), -1 for the days without a row
+    rows : list with the row positions of the days of every year in the smoothed output, -1 for the days
+           without a row. The first and last day of a year have a row
+    smoothed : list, for every year the index of its window in windows or -1 if it is not smoothed
+    days : list, for every smoothed year the positions of its days in its window, None if it is not smoothed
+    climatology : for gap_fill 'climatology' a list with the mean of all years at the doy of every day of
+                  each window, None for 'linear'
+
+    '''
+
+    if gap_fill not in ('linear', 'climatology'):
+        raise ValueError("gap_fill must be 'linear' or 'climatology'")
+
+    Var_Years, index=_year_grid(year, doy)
+    n_years=len(Var_Years)
+    j=np.arange(n_years)
+    flat=index.ravel()
+
+    #the days of each year, from its first to its last row, at the positions 366*j+first to 366*j+last of flat
+    valid=index>=0
+    first=valid.argmax(axis=1)
+    last=366-valid[:, ::-1].argmax(axis=1)
+    length=last-first
+    rows=_split(flat[_segment_positions(366*j+first, length)], length)
+
+    #Smooth only years with less than max_missing nan values or days without a row in their span
+    k=np.arange(366)
+    in_span=(k>=first[:, None]) & (k<last[:, None])
+    missing=(in_span & (~valid | np.isnan(np.where(valid, Var[index], 0)))).sum(axis=1)
+    ok=missing<max_missing
+    smoothed=np.where(ok, np.cumsum(ok)-1, -1)
+
+    if padding is None:
+
+        #Whole record, a year continues the window of the previous year if that year is smoothed. A run
+        #of years goes from the first day of its first year to the last day of its last year, with all
+        #calendar days in between (the days without a row are -1)
+        start_run=ok & ~np.r_[False, ok[:-1] & (Var_Years[1:]==Var_Years[:-1]+1)]
+        end_run=ok & np.r_[start_run[1:] | ~ok[1:], True]
+        calendar=np.where((Var_Years%4==0) & ((Var_Years%100!=0) | (Var_Years%400==0)), 366, 365)
+        begin=np.where(start_run, first, 0)
+        end=np.where(end_run, last, calendar)
+
+        run=np.cumsum(start_run)-1
+        smoothed=np.where(ok, run, -1)
+        part=np.where(ok, end-begin, 0)
+        position=_segment_positions(366*j+begin, part)
+
+        #position of the first day of each year in the window of its run
+        offset=np.cumsum(part)-part
+        offset=offset-np.r_[offset[start_run], 0][run]+first-begin
+        days_ok=_split(_segment_positions(offset[ok], length[ok]), length[ok])
+        window_length=np.bincount(run[ok], weights=part[ok], minlength=start_run.sum()).astype(int)
+
+    else:
+
+        #For smoothing add padding days before and after the year from the same year end points. The
+        #padding before is the end of the previous year (the first days of the first year) and the padding
+        #after the start of the next year (the last days of the last year)
+        prev=np.maximum(j-1, 0)
+        nxt=np.minimum(j+1, n_years-1)
+        begin_b=np.where(j>0, 366*prev+np.maximum(last[prev]-padding, first[prev]), 366*j+first)
+        length_b=np.where(j>0, 366*prev+last[prev]-begin_b, np.minimum(padding, length))
+        begin_a=np.where(j<n_years-1, 366*nxt+first[nxt], 366*j+np.maximum(last-padding, first))
+        length_a=np.where(j<n_years-1, np.minimum(padding, length[nxt]), 366*j+last-begin_a)
+
+        segments=np.column_stack([begin_b, 366*j+first, begin_a])[ok]
+        part=np.column_stack([length_b, length, length_a])[ok]
+        position=_segment_positions(segments.ravel(), part.ravel())
+
+        #The days of the year without the padding
+        days_ok=_split(_segment_positions(length_b[ok], length[ok]), length[ok])
+        window_length=part.sum(axis=1)
+
+    windows=_split(flat[position], window_length)
+    days=[None]*n_years
+    for i, d in zip(np.flatnonzero(ok), days_ok):
+        days[i]=d
+
+    if gap_fill == 'linear':
+        return windows, rows, smoothed.tolist(), days, None
+
+    #Mean of all years at each doy, the doys without any value are interpolated from the others
+    Var_grid=np.where(valid, Var[index], np.nan)
+    n=(~np.isnan(Var_grid)).sum(axis=0)
+    mean=np.nansum(Var_grid, axis=0)/np.maximum(n, 1)
+    if not n.any():
+        mean[:]=0
+    elif not n.all():
+        mean[n==0]=np.interp(np.flatnonzero(n==0), np.flatnonzero(n>0), mean[n>0], period=366)
+
+    return windows, rows, smoothed.tolist(), days, _split(mean[position % 366], window_length)
+
+
+
+def _natural_cubic_spline(knots, basis_len):
+
     '''
 
+    Basis for natural cubic spline regression, the same as natural_cubic_spline of tsmoothie's regression_basis
 
-    # Define rows in the output dataframe, Pheno_out
-    rows = []
+    '''
 
-    #number of total years
-    Var_Years=np.unique(df['year'])
+    n_knots = len(knots)
+    X = np.arange(basis_len)
 
-    #Smooth Var using integral_smoothing
-    if  Smoothing == "True":
-        df=integral_smoothing(df, knots)
+    X_base = np.zeros((basis_len, n_knots - 1))
+    X_base[:, 0] = X
 
-    #Take the raw Var
-    if  Smoothing == "False":
-        df=direct_smoothing(df, knots)
+    numerator1 = X[:, None] - knots[None, :n_knots - 2]
+    numerator1[numerator1 < 0] = 0
+    numerator2 = X[:, None] - knots[None, n_knots - 1]
+    numerator2[numerator2 < 0] = 0
 
+    numerator = np.power(numerator1, 3) - np.power(numerator2, 3)
+    denominator = knots[n_knots - 1] - knots[:n_knots - 2]
 
-    for j, element in enumerate(Var_Years): #Loop over years
+    numerator1_dd = X[:, None] - knots[None, n_knots - 2]
+    numerator1_dd[numerator1_dd < 0] = 0
+    numerator2_dd = X[:, None] - knots[None, n_knots - 1]
+    numerator2_dd[numerator2_dd < 0] = 0
 
-        df_jyear=df.loc[df['year'] ==Var_Years[j]]  #the dataframe for year j
+    numerator_dd = np.power(numerator1_dd, 3) - np.power(numerator2_dd, 3)
+    denominator_dd = knots[n_knots - 1] - knots[n_knots - 2]
 
-        # peak of season, POS
-        pos=df.iloc[df_jyear.Var.argmax(), 2] # it is when the maximum of var (GPP here) occurs
+    dd = numerator_dd / denominator_dd
 
+    X_base[:, 1:] = numerator / denominator - dd
 
-        #SOS, EOS, GSL from threshold method
+    return X_base
 
-        #Normalize the year such that all values lie between 0 to 1, 1 being value at pos
-        Var_n=(df_jyear.Var -min(df_jyear.Var ))/(max(df_jyear.Var )-min(df_jyear.Var )  )
 
-        #Points threshold line crosses
-        line_cross=np.argwhere(np.diff(np.sign(Var_n - Threshold_value))).flatten()
 
-        # If it is not the first year (j>0) then also get the points where the threshold line crosses the previous year
-        if j>0:
-            df_jyear_p=df.loc[df['year'] ==Var_Years[j-1]] #the dataframe for year j-1
+@functools.lru_cache(maxsize=16)
+def _spline_basis(length, knots):
 
-            #Normalize the previous year such that all values lie between 0 to 1, 1 being value at pos in year j
-            Var_n_p=(df_jyear_p.Var -min(df_jyear.Var ))/(max(df_jyear.Var )-min(df_jyear.Var )  )
+    '''
 
-            #The points threshold line crosses in previous year
-            line_cross_p=np.argwhere(np.diff(np.sign(Var_n_p - Threshold_value))).flatten()
+    Natural cubic spline basis of a window, with knots placed as in tsmoothie's SplineSmoother
 
-        # If it is not the last year (j<len(Var_Years)-1) then also get the points where the threshold line crosses the next year
-        if j<len(Var_Years)-1:
-            df_jyear_n=df.loc[df['year'] ==Var_Years[j+1]] #the dataframe for year j+1
+    Returns
+    -------
+    X_base : the basis, array of shape (length, knots-1)
+    X_offset : mean of the basis
+    X_center : the centered basis used in the least squares regression with intercept
 
-            #Normalize the next year such that all values lie between 0 to 1, 1 being value at pos in year j
-            Var_n_n=(df_jyear_n.Var -min(df_jyear.Var ))/(max(df_jyear.Var )-min(df_jyear.Var )  )
+    '''
 
-            #The points threshold line crosses in next year
-            line_cross_n=np.argwhere(np.diff(np.sign(Var_n_n - Threshold_value))).flatten()
+    if knots>length:
+        raise ValueError("n_knots must be <= than timesteps dimension of the data received")
 
-        # If number of nan in the year is less than 50 then only start the search for PTDs
-        if df_jyear['Var'].isnull().sum()<50:
-            eos=9999 #false value
-            sos=9999 #false value
-            gsl=9999
+    X_base=_natural_cubic_spline(np.linspace(0, length, knots + 2)[1:-1], length)
+    X_offset=np.average(X_base, axis=0, weights=np.ones(length))
+    X_center=X_base-X_offset
 
-             #CASE 1: If threshold line crosses 2 points, normal case, sos<pos and eos>pos
-            if len(line_cross)==2 and line_cross[0]<pos and line_cross[1]>pos: # order sos-pos-eos
-                sos=line_cross[0]+1
-                eos=line_cross[1]+1
+    for X in (X_base, X_offset, X_center):
+        X.setflags(write=False)
 
+    return X_base, X_offset, X_center
 
-            #CASE 2: If threshold line crosses >=1 point before pos
-            if len(line_cross)>=1 and line_cross[-1]<pos and j<len(Var_Years): #order sos-pos-eos(next year)
-                sos=line_cross[-1] +1
 
-                if len(line_cross_n)>=1: # If the threshold line passes through next year
-                    eos=line_cross_n[0] +1 #eos calculated from next year, , not possible for last year (j<len(Var_Years))
 
-            #CASE 3: If threshold line crosses >=1 point after pos,
-            if len(line_cross)>=1 and line_cross[0]>pos and j>0: #order sos(previous year)-pos-eos
-                eos=line_cross[0] +1
-                if len(line_cross_p)>=1: # If the threshold line passes through previous year
-                    sos=line_cross_p[-1] +1 #sos calculated from previous year, not possible for first year (j>0)
+@functools.lru_cache(maxsize=32)
+def _spline_svd(length, knots):
 
+    '''
 
-            #CASE 4: If threshold line crosses >= 2 points, and pos is in between
-            if len(line_cross)>=2 and line_cross[0]<pos and line_cross[-1]>pos: # order sos-pos-eos
-                sos= line_cross[line_cross < pos].min() +1
-                eos= line_cross[line_cross > pos].min() +1
+    Orthonormal basis U of the centered spline basis, from its singular value decomposition.
+    Singular values are cut as in np.linalg.lstsq
 
+    '''
 
+    X_base, X_offset, X_center=_spline_basis(length, knots)
 
+    U, S, Vt=np.linalg.svd(X_center, full_matrices=False)
+    U=U[:, S > np.finfo(float).eps * max(X_center.shape) * S[0]]
+    U.setflags(write=False)
 
+    return U
 
-            # growing season length
-            #For CASE 1 and CASE 4
-            if eos<9999 and sos<9999 and sos<pos and eos>pos:
-                gsl=eos-sos
 
-            #For CASE 2
-            if eos<9999 and sos<9999 and sos<pos and eos<pos:
-                gsl=365- sos + eos
 
-            #FOR CASE 3
-            if eos<9999 and sos<9999 and sos>pos and eos>pos:
-                gsl= eos + 365-sos
+@functools.lru_cache(maxsize=16)
+def _spline_projection(length, knots):
 
+    '''
 
+    Projection (hat) matrix of the natural cubic spline least squares fit with intercept
 
-            #SOS, EOS, GSL from first derivative method
+    The fitted values of a window y are _spline_projection(len(y), knots) @ y. The matrix only depends on
+    the window length and the knots, so it is computed once and the least recently used ones are dropped.
 
-            eos_der=9999
-            sos_der=9999
+    '''
 
+    U=_spline_svd(length, knots)
 
-            #CASE 1: If threshold line crosses 2 points, normal case, sos<pos and eos>pos
-            if sos<pos and eos>pos: # order sos-pos-eos
-                Var_1der=np.gradient(df_jyear.Var,1)
-                Var_1der= signal.savgol_filter(Var_1der, window_length=101, polyorder=3, mode="nearest")
-                sos_der=Var_1der[0:pos].argmax() +1
-                eos_der=Var_1der[pos:-1].argmin() +1
-                
+    #projection on the spline basis plus the intercept
+    H=U @ U.T + 1.0/length
+    H.setflags(write=False)
 
-            #CASE 2: If threshold line crosses >=1 point before pos
-            if len(line_cross)>=1 and line_cross[-1]<pos and j<len(Var_Years): #order sos-pos-eos(next year)
-                Var_1der=np.gradient(df_jyear.Var,1)
-                Var_1der= signal.savgol_filter(Var_1der, window_length=101, polyorder=3, mode="nearest")
-                sos_der=Var_1der[0:pos].argmax() +1
+    return H
 
-                if len(line_cross_n)>=1: # If the threshold line passes through next year
-                    frames = [df_jyear[pos:-1], df_jyear_n]
-                    result = pd.concat(frames)
-                    result=result.reset_index(drop=True)
-                    Var_1der=np.gradient(result.Var,1)
-                    Var_1der= signal.savgol_filter(Var_1der, window_length=101, polyorder=3, mode="nearest")
-                    eos_der=Var_1der[pos:-1].argmin() + 1
 
 
-            #CASE 3: If threshold line crosses >=1 point after pos,
-            if len(line_cross)>=1 and line_cross[0]>pos and j>0: #order sos(previous year)-pos-eos
-                Var_1der=np.gradient(df_jyear.Var,1)
-                Var_1der= signal.savgol_filter(Var_1der, window_length=101, polyorder=3, mode="nearest")
-                eos_der=Var_1der.argmin() + 1
+@functools.lru_cache(maxsize=64)
+def _gcv_operator(length, knots, integral):
 
-                if len(line_cross_p)>=1: # If the threshold line passes through previous year
-                    sos=line_cross_p[-1] +1 #sos calculated from previous year, not possible for first year (j>0)
-                    frames = [df_jyear_p[eos_der:-1], df_jyear[0:pos]] #eos of previous year to pos of present year
-                    result = pd.concat(frames)
-                    result=result.reset_index(drop=True)
-                    Var_1der=np.gradient(result.Var,1)
-                    Var_1der= signal.savgol_filter(Var_1der, window_length=101, polyorder=3, mode="nearest")
-                    sos_der=Var_1der.argmax() #position of sos_der
-                    #correct for previouse or same year
-                    pyl=len(df_jyear_p[eos_der:-1]) #length of previous year from eos to end of season
-                    sos_der=sos_der-len(df_jyear_p[eos_der:-1]) 
+    '''
 
-            #CASE 4: If threshold line crosses >= 2 points, and pos is in between
+    Factors of the smoother of the daily values of a window, for generalized cross-validation
 
-            if len(line_cross)>=2 and line_cross[0]<pos and line_cross[-1]>pos: # order sos-pos-eos
-                Var_1der=np.gradient(df_jyear.Var,1)
-                Var_1der= signal.savgol_filter(Var_1der, window_length=201, polyorder=3, mode="nearest")
-                sos_der=Var_1der[0:pos].argmax() +1
-                eos_der=Var_1der.argmin() +1
+    The smoothed values of a window y are A @ (B.T @ y), plus the mean of y for direct smoothing.
+    For integral smoothing the cumulative is smoothed and differentiated, so A is the gradient of U
+    and B the cumulative of U summed from the end. The intercept of the spline vanishes in the gradient.
 
-            # growing season length
-            gsl_der=eos_der -sos_der
+    Returns
+    -------
+    A, B : arrays of shape (length, rank of the spline basis)
+    trace : trace of the smoother, its effective number of parameters
 
-            if gsl_der<0:
-                gsl_der=gsl_der+365
+    '''
 
+    U=_spline_svd(length, knots)
 
-            rows.append([Var_Years[j], sos, pos, eos, gsl, sos_der, eos_der, gsl_der]) #Raw sos, pos, eos [0 to 365]
+    if integral:
+        A=np.gradient(U, 1, axis=0)
+        B=np.cumsum(U[::-1], axis=0)[::-1]
+        trace=np.sum(A*B)
+    else:
+        A=B=U
+        trace=U.shape[1]+1
 
-        # If number of nan in the year is greater than 50 then PTDs are nan
-        else:
-            rows.append([Var_Years[j], np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan])
+    return A, B, trace
 
-        df_pheno = pd.DataFrame(rows, columns=["Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der"])
-        df_pheno_out = pd.DataFrame(rows, columns=["Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der"])
 
-        #correct for order sos,pos,eos
 
-        #eos<pos ( eos in next year), CASE 2
-        df_pheno_out['EOS'] = df_pheno_out.apply(lambda x: x['EOS'] +365 if x['EOS'] <= x['POS'] and x['EOS']< 9999 else x['EOS'], axis=1)
+@_staged
+def _auto_knots(windows, integral, candidates=range(8, 16), climatology=None):
 
-        #sos>pos ( sos in previous year), CASE 3
-        df_pheno_out['SOS'] = df_pheno_out.apply(lambda x: x['SOS'] -365 if x['SOS'] >= x['POS'] and x['SOS']< 9999 else x['SOS'], axis=1)
+    '''
 
-        #Replace default value of 9999 to nan
-        #The dataframe with smoothed Var [ output 1]
-        df_pheno_out=df_pheno_out.replace({9999:np.nan})
+    Number of knots of a site chosen by generalized cross-validation (GCV)
 
-        #The dataframe with smoothed Var [ output 2]
-        df_smooth=df
+    For each candidate the GCV score n*RSS/(n-trace)**2 of every window is computed with the cached factors
+    of _gcv_operator, without smoothing the windows, and the candidate with the smallest sum of the scores
+    over the windows of the site is chosen. The RSS and the trace are those of the smoothed daily values,
+    also for integral smoothing.
 
-    return df_pheno_out, df_smooth
+    Parameters
+    ----------
+    windows : list of arrays with the raw values of Var in each window of the site
+    integral : True for integral smoothing, False for direct smoothing
+    candidates : the numbers of knots that are tried, by default 8 to 15
+    climatology : list with the climatology of each window for gap_fill 'climatology', see _smoothing_windows
+
+    Returns
+    -------
+    knots : the chosen number of knots
+
+    '''
+
+    score=np.zeros(len(candidates))
+    lengths=np.array([len(window) for window in windows])
+
+    for length in np.unique(lengths):
+        idx=np.flatnonzero(lengths==length)
+        Var_stack=_fill_gaps(np.vstack([windows[i] for i in idx]),
+                             None if climatology is None else np.vstack([climatology[i] for i in idx]))
+        Var_stack=Var_stack[~np.isnan(Var_stack).any(axis=1)]
+
+        for c, knots in enumerate(candidates):
+            if knots>length:
+                score[c]=np.inf
+                continue
+
+            A, B, trace=_gcv_operator(length, knots, integral)
+            fit=(Var_stack @ B) @ A.T
+            if not integral:
+                fit+=Var_stack.mean(axis=1, keepdims=True)
+
+            rss=((Var_stack-fit)**2).sum(axis=1)
+            score[c]+=np.sum(length*rss/(length-trace)**2)
+
+    return int(candidates[np.argmin(score)])
+
+
+
+@functools.lru_cache(maxsize=16)
+def _bspline_factor(length, knots):
+
+    '''
+
+    Cubic B-spline basis of a whole-record window and the banded Cholesky factor of its normal equations
+
+    The knots are evenly spaced with knots+1 intervals in every 365 days, so the record has the knots of
+    the padded spline in each of its years. Every row of the basis has 4 nonzero values and B.T@B has 4
+    diagonals, so the fit of a window is one banded solve, linear in the length of the record.
+
+    Returns
+    -------
+    B : sparse basis of shape (length, number of B-splines)
+    cb : the banded Cholesky factor of B.T@B, in the upper form of scipy.linalg.cho_solve_banded
+
+    '''
+
+    from scipy.interpolate import BSpline
+    from scipy.linalg import cholesky_banded
+
+    n_intervals=max(1, int(round(length*(knots+1)/365)))
+    inner=np.linspace(0, length-1, n_intervals+1)
+    B=BSpline.design_matrix(np.arange(length, dtype=float), np.r_[[inner[0]]*3, inner, [inner[-1]]*3], 3)
+
+    #diagonals of B.T@B, diagonal k in row 3-k
+    BtB=(B.T @ B).tocsr()
+    ab=np.zeros((4, B.shape[1]))
+    for k in range(4):
+        ab[3-k, k:]=BtB.diagonal(k)
+
+    cb=cholesky_banded(ab)
+    cb.setflags(write=False)
+
+    return B, cb
+
+
+
+@functools.lru_cache(maxsize=16)
+def _whittaker_cholesky(length, lam, order):
+
+    '''
+
+    Banded Cholesky factor of I + lam*D.T@D, with D the difference matrix of the given order, for the
+    Whittaker smoother. The matrix has order+1 diagonals, so the factor and the solves are linear in length
+
+    '''
+
+    from scipy.linalg import cholesky_banded
+
+    #coefficients of the differences, for order 2 [1, -2, 1]
+    c=np.diff(np.eye(order+1), order, axis=0)[0]
+
+    #diagonals of D.T@D in the upper form of scipy.linalg.solveh_banded, diagonal k in row order-k
+    ab=np.zeros((order+1, length))
+    for k in range(order+1):
+        for a in range(order+1-k):
+            ab[order-k, k+a:length-order+a+k]+=lam*c[a]*c[a+k]
+    ab[order]+=1
+
+    cb=cholesky_banded(ab)
+    cb.setflags(write=False)
+
+    return cb
+
+
+
+def _whittaker(Var_stack, knots, integral):
+
+    '''
+
+    Whittaker smoother of the rows of Var_stack, with penalty lam on the differences of order 2
+    (order 3 for the cumulative of integral smoothing). lam is set from knots so that the
+    smoother keeps the periods longer than two knot spacings of a year, as the spline does
+
+    '''
+
+    from scipy.linalg import cho_solve_banded
+
+    order=3 if integral else 2
+    lam=(365/(knots+1)/np.pi)**(2*order)
+    cb=_whittaker_cholesky(Var_stack.shape[1], lam, order)
+
+    return cho_solve_banded((cb, False), Var_stack.T).T
+
+
+
+def _savgol(Var_stack, knots, integral):
+
+    '''
+
+    Savitzky-Golay filter of the rows of Var_stack with a cubic polynomial in a window of two knot
+    spacings of a year (67 days for 10 knots). The ends of a window are fitted with mode 'interp'
+
+    '''
+
+    from scipy.signal import savgol_filter
+
+    window=2*int(round(365/(knots+1)))+1
+    length=Var_stack.shape[1]
+    window=min(window, length-1+length%2)
+
+    return savgol_filter(Var_stack, window, 3, axis=1, mode='interp')
+
+
+
+def _harmonic(Var_stack, knots, integral):
+
+    '''
+
+    Harmonic fit of the rows of Var_stack with the FFT. The line through the first and last value is
+    removed so that a row is continuous at its ends, the harmonics with a period shorter than two knot
+    spacings of a year are set to zero and the line is added back
+
+    '''
+
+    length=Var_stack.shape[1]
+    n_harmonics=max(1, int(round(length*(knots+1)/730)))
+
+    trend=Var_stack[:, :1] + (Var_stack[:, -1:]-Var_stack[:, :1])*np.linspace(0, 1, length)
+    coef=np.fft.rfft(Var_stack-trend, axis=1)
+    coef[:, n_harmonics+1:]=0
+
+    return np.fft.irfft(coef, length, axis=1)+trend
+
+
+
+#Smoothers of the backends other than the natural cubic spline, by name. A smoother takes the stack of windows
+#(windows, days), the number of knots and integral and returns the smoothed stack
+_smoothers={'whittaker': _whittaker, 'savgol': _savgol, 'harmonic': _harmonic}
+
+
+
+def _check_backend(backend):
+
+    '''
+
+    Raises a ValueError for an unknown backend
+
+    '''
+
+    if not callable(backend) and backend not in ('spline', 'projection', *_smoothers):
+        raise ValueError("backend must be 'spline', 'projection', 'whittaker', 'savgol', 'harmonic' or a function")
+
+
+
+def _smooth_windows(windows, knots, integral, backend='spline', record=False, climatology=None):
+
+    '''
+
+    Smooths a list of padded windows with the natural cubic spline or another backend
+
+    Windows of the same length are stacked in an array of shape (windows, days). With backend 'spline'
+    each window is fitted with the same least squares regression as tsmoothie's SplineSmoother, which
+    gives the results of tsmoothie to the last bit. With backend 'projection' the stack is multiplied with
+    the projection matrix of the spline, row by row, so a window gets the same smoothed values whether
+    it is smoothed alone or with other years and sites. The backends 'whittaker', 'savgol' and 'harmonic'
+    (see _smoothers) and a function backend(Var_stack, knots, integral) smooth the whole stack at once.
+    For whole-record windows (record True) backends 'spline' and 'projection' fit the cubic B-spline of
+    _bspline_factor with knots in every year instead.
+
+    Parameters
+    ----------
+    windows : list of arrays with the raw values of Var in each window
+    knots : number of knots of the spline, or a sequence with the number of knots of each window
+    integral : if True the cumulative of Var is smoothed and differentiated (integral smoothing),
+               otherwise Var is smoothed directly
+    backend : 'spline', 'projection', 'whittaker', 'savgol', 'harmonic' or a function
+    record : True if the windows are whole records (padding None of _smoothing_windows)
+    climatology : list with the climatology of each window for gap_fill 'climatology', see _smoothing_windows,
+                  None fills the gaps linearly
+
+    Returns
+    -------
+    smooth : list of arrays with the smoothed values of each window
+
+    '''
+
+    _check_backend(backend)
+    smoother=_smoothers.get(backend, backend) if backend not in ('spline', 'projection') else None
+
+    smooth=[None]*len(windows)
+    lengths=np.array([len(window) for window in windows])
+    knots_windows=np.broadcast_to(knots, lengths.shape)
+
+    #windows with the same length and knots are smoothed together
+    for length, knots in sorted(set(zip(lengths.tolist(), knots_windows.tolist()))):
+        idx=np.flatnonzero((lengths==length) & (knots_windows==knots))
+
+        #fill the gaps of all windows at once
+        with _stage('gap_fill'):
+            Var_stack=_fill_gaps(np.vstack([windows[i] for i in idx]),
+                                 None if climatology is None else np.vstack([climatology[i] for i in idx]))
+        if np.isnan(Var_stack).any():
+            raise ValueError("data must not contain NaNs or Inf, nan values at the start of a smoothing window cannot be interpolated")
+
+        # Calculate Cumulative of Variable from raw Var values
+        if integral:
+            Var_stack=np.cumsum(Var_stack, axis=1)
+
+        #smooth the signal with spline or the smoother of the backend
+        with _stage('spline' if smoother is None else getattr(smoother, '__name__', 'smoother').strip('_')):
+            if smoother is not None:
+                Var_stack=smoother(Var_stack, knots, integral)
+
+            elif record:
+                from scipy.linalg import cho_solve_banded
+                B, cb=_bspline_factor(length, knots)
+                Var_stack=(B @ cho_solve_banded((cb, False), (B.T @ Var_stack.T))).T
+
+            elif backend == 'projection':
+                H=_spline_projection(length, knots)
+                Var_stack=np.matmul(Var_stack[:, None, :], H)[:, 0, :]
+
+            else:
+                X_base, X_offset, X_center=_spline_basis(length, knots)
+                for i, Var_window in enumerate(Var_stack):
+                    Var_offset=np.average(Var_window, axis=0, weights=np.ones(length))
+                    coef=np.linalg.lstsq(X_center, Var_window-Var_offset, rcond=None)[0]
+                    Var_stack[i]=X_base @ coef + (Var_offset-np.dot(X_offset, coef))
+
+        #Take the differentiation of the smoothed cumulative values
+        if integral:
+            with _stage('gradient'):
+                Var_stack=np.gradient(Var_stack, 1, axis=1)
+
+        for i, Var_smooth in zip(idx, Var_stack):
+            smooth[i]=Var_smooth
+
+    return smooth
+
+
+
+def _smoothed_values(smooth, rows, smoothed, days):
+
+    '''
+
+    Smoothed values of one site in the order of the rows returned by _smoothing_windows,
+    the padding is removed and years that are not smoothed are nan
+
+    '''
+
+    Var_smooth=np.full(sum(len(r) for r in rows), np.nan)
+
+    start=0
+    for i, r, d in zip(smoothed, rows, days):
+        if i>=0:
+            Var_smooth[start:start+len(r)]=smooth[i][d]
+        start+=len(r)
+
+    return Var_smooth
+
+
+
+def _smooth_frame(df, knots, integral, backend, padding, gap_fill='linear', max_missing=50):
+
+    '''
+
+    Smooths Var of a dataframe with columns time, year, doy and Var, for integral_smoothing and direct_smoothing
+
+    Returns
+    -------
+    df_smooth : the rows of df with the smoothed Var
+    span : year, doy and smoothed Var of all days of the smoothed years, also of the days without a row in df,
+           the input of the PTDs
+
+    '''
+
+    year=df['year'].to_numpy()
+    doy=df['doy'].to_numpy()
+    Var=df['Var'].to_numpy(dtype=float)
+
+    _check_backend(backend)
+
+    #padded windows of all years, smoothed at once
+    windows, rows, smoothed, days, climatology=_smoothing_windows(year, doy, Var, padding, gap_fill, max_missing)
+    windows=[_window_values(Var, window) for window in windows]
+
+    #number of knots chosen by generalized cross-validation, from the padded windows of the years
+    if knots == "auto":
+        if padding is None:
+            windows_auto, climatology_auto=_smoothing_windows(year, doy, Var, 20, gap_fill, max_missing)[::4]
+            knots=_auto_knots([_window_values(Var, window) for window in windows_auto], integral, climatology=climatology_auto)
+        else:
+            knots=_auto_knots(windows, integral, climatology=climatology)
+
+    smooth=_smooth_windows(windows, knots, integral, backend, padding is None, climatology)
+
+    #Store the smoothed values for each year, with the number of knots used
+    with _stage('frame'):
+        Var_smooth=_smoothed_values(smooth, rows, smoothed, days)
+        rows_smooth=np.concatenate(rows)
+        present=rows_smooth>=0
+
+        df_smooth=df.iloc[rows_smooth[present]].copy()
+        df_smooth['Var']=Var_smooth[present]
+        df_smooth.attrs['knots']=knots
+
+    return df_smooth, (*_span_days(rows, year, doy), Var_smooth)
+
+
+
+def _segment_rows(Var, start_a, length_a, start_b=None, length_b=None):
+
+    '''
+
+    Matrix with one row per year from segments of Var, padded with nan
+
+    Row r is Var[start_a[r]:start_a[r]+length_a[r]], followed by Var[start_b[r]:start_b[r]+length_b[r]] if given.
+
+    Returns
+    -------
+    X : array of shape (rows, maximum length)
+    length : the length of each row
+
+    '''
+
+    if start_b is None:
+        start_b=length_b=np.zeros_like(length_a)
+
+    length=length_a+length_b
+    k=np.arange(max(length.max(initial=0), 2))
+
+    index=np.where(k<length_a[:, None], start_a[:, None]+k, start_b[:, None]+k-length_a[:, None])
+    valid=k<length[:, None]
+
+    X=np.full(index.shape, np.nan)
+    X[valid]=Var[index[valid]]
+
+    return X, length
+
+
+
+@_staged
+def _derivative_rows(X, length, window_length):
+
+    '''
+
+    First derivative of each row of _segment_rows filtered with the Savitzky-Golay filter, as
+    savgol_filter(np.gradient(row,1), window_length, polyorder=3, mode="nearest") on each row alone
+
+    The gradient and the filter are applied once along axis=1. The last value of each row is
+    repeated after its end, which is the "nearest" mode of the filter, so rows of different lengths
+    get the same values as when they are filtered alone. Rows need at least 2 values.
+
+    '''
+
+    rows=np.arange(len(X))
+    last=np.maximum(length-1, 1)
+
+    Var_1der=np.gradient(X, 1, axis=1)
+
+    #one-sided difference at the end of each row
+    Var_1der[rows, last]=(X[rows, last]-X[rows, last-1]) / 1
+
+    Var_1der=np.where(np.arange(X.shape[1])<=last[:, None], Var_1der, Var_1der[rows, last][:, None])
+
+    from scipy.signal import savgol_filter
+
+    with _stage('savgol'):
+        return savgol_filter(Var_1der, window_length=window_length, polyorder=3, mode="nearest", axis=1)
+
+
+
+def _arg_rows(Var_1der, start, stop, function):
+
+    '''
+
+    argmax (function=np.argmax) or argmin (np.argmin) of Var_1der[r, start[r]:stop[r]] for each row r,
+    relative to start[r]. As for a single array, a nan value in the range is returned first.
+
+    Returns
+    -------
+    arg : the position in each range
+    empty : True for the rows with an empty range
+
+    '''
+
+    k=np.arange(Var_1der.shape[1])
+    fill=-np.inf if function is np.argmax else np.inf
+
+    arg=function(np.where((k>=start[:, None]) & (k<stop[:, None]), Var_1der, fill), axis=1) - start
+
+    return arg, stop<=start
+
+
+
+@_staged
+def _phenology_site(year, doy, Var, Threshold_value, years=None, site=None, strict=True, max_missing=50, site_names=None):
+
+    '''
+
+    PTDs of one site from its smoothed values, same as the year loop of EasyPhenology
+
+    The years are the rows of a (years x days) matrix padded with nan, and the normalization, the
+    threshold crossings of each year and of its previous and next year, the CASE 1 to 4 of the
+    threshold and derivative methods and the derivative curves are computed for all years at once.
+    For a sequence of thresholds only the crossings and the CASE selection are done for each
+    threshold, the normalization and the derivative curves are computed once.
+
+    Parameters
+    ----------
+    year, doy, Var : arrays with the columns year, doy and Var of the smoothed dataframe
+    Threshold_value : the fixed percentage of the annual maximum, from 0 to 1, or a sequence of them
+    years : if given, the PTDs are only computed for these year numbers (0 for the first year),
+            the other years are nan
+    site : if given, integer code of the site of each row, with the rows of a site together. The sites
+           are processed as separate sites in one call, for example replicates of the same site
+    strict : if False, years for which the derivative method fails get nan PTDs instead of an error
+    max_missing : years with this number of nan values or more get nan PTDs, 50 by default
+    site_names : names of the site codes, the sites of the years recorded by a PhenologyProfile
+
+    Returns
+    -------
+    Var_Years : the years, repeated for each site
+    ptd : array of shape (years, 7) with "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der", "GSL_der",
+          SOS in the previous year is negative and EOS in the next year is after the last day of the year.
+          Shape (thresholds, years, 7) for a sequence of thresholds. 9999 if a PTD is not found
+
+    '''
+
+    year=np.asarray(year)
+
+    #years of different sites are kept apart with a key of site and year
+    if site is not None and len(year):
+        span=year.max()-year.min()+1
+        key=np.asarray(site)*span + (year-year.min())
+        keys, index=_year_grid(key, doy)
+        Var_Years=keys % span + year.min()
+        site_key=keys // span
+    else:
+        Var_Years, index=_year_grid(year, doy)
+        site_key=np.zeros(len(Var_Years), dtype=int)
+
+    #Dense layout, year j holds its days 1 to n[j] (the last day with a row) from position 366*j.
+    #Days without a row are nan. The year starts on day s[j]+1, its first day with a row, so the days
+    #before the first row of a partial first year are not part of the year
+    n_years=len(Var_Years)
+    n=366-(index>=0)[:, ::-1].argmax(axis=1)
+    s=(index>=0).argmax(axis=1)
+    Var=np.where(index>=0, np.asarray(Var, dtype=float)[index], np.nan).ravel()
+    starts=366*np.arange(n_years)
+    j=np.arange(n_years)
+
+    #number of days of each calendar year, for SOS in the previous year and EOS in the next year
+    days=np.where((Var_Years%4==0) & ((Var_Years%100!=0) | (Var_Years%400==0)), 366, 365)
+
+    #first and last year of each site
+    first_year=np.r_[True, site_key[1:]!=site_key[:-1]]
+    last_year=np.r_[site_key[1:]!=site_key[:-1], True]
+
+    #thresholds along the first axis
+    threshold=np.reshape(Threshold_value, (-1, 1, 1))
+    n_thresholds=len(threshold)
+
+    # PTDs of each year, nan if the year has max_missing or more nan values
+    ptd=np.full((n_thresholds, n_years, 7), np.nan)
+
+    selected=np.zeros(n_years, dtype=bool)
+    selected[j if years is None else list(years)]=True
+
+    if n_years==0:
+        return Var_Years, ptd if np.ndim(Threshold_value) else ptd[0]
+
+    # The values of all years
+    Var_j, n=_segment_rows(Var, starts, n)
+    k=np.arange(Var_j.shape[1])
+    nan=np.isnan(Var_j)
+    padding=k>=n[:, None]
+
+    # peak of season, POS
+    Var_pos=np.where(nan, -np.inf, Var_j).argmax(axis=1)
+    pos=np.where((nan | padding).all(axis=1), n, Var_pos+1)
+
+    #Normalize the year such that all values lie between 0 to 1, 1 being value at pos,
+    #minimum and maximum as python's min and max that skip nan values after the first value of the year
+    first_nan=nan[j, s]
+    Var_min=np.where(first_nan, np.nan, np.where(nan, np.inf, Var_j).min(axis=1))
+    Var_max=np.where(first_nan, np.nan, np.where(nan, -np.inf, Var_j).max(axis=1))
+
+    # The previous year (j>0) and the next year (j<len(Var_Years)-1). The last year has no next year,
+    # EasyPhenology then keeps the next year of the previous iteration, that is the last year itself
+    # normalized with the previous year
+    prev=np.where(first_year, j, j-1)
+    nxt=np.where(last_year, j, j+1)
+    nxt_scale=np.where(last_year, prev, j)
+    has_p=~first_year
+    has_nx=~last_year | ~first_year
+
+    with np.errstate(divide='ignore', invalid='ignore'), _stage('threshold'):
+
+        def crossings(rows, scale, exists):
+            #Points threshold line crosses for each threshold, a nan difference is a crossing
+            Var_n=(Var_j[rows] -Var_min[scale, None])/(Var_max[scale, None]-Var_min[scale, None])
+            line_cross=np.diff(np.sign(Var_n - threshold), axis=2)!=0
+            return line_cross & (k[:-1]>=s[rows, None]) & (k[:-1]<n[rows, None]-1) & exists[:, None]
+
+        line_cross=crossings(j, j, np.ones(n_years, dtype=bool))
+        line_cross_p=crossings(prev, j, has_p)
+        line_cross_n=crossings(nxt, nxt_scale, has_nx)
+
+    # Number of crossings and first and last crossing, for each threshold and year
+    n_cross=line_cross.sum(axis=2)
+    first=line_cross.argmax(axis=2)
+    last=line_cross.shape[2]-1-line_cross[..., ::-1].argmax(axis=2)
+    first_after=(line_cross & (k[:-1]>pos[:, None])).argmax(axis=2)
+    n_cross_p=line_cross_p.sum(axis=2)
+    last_p=line_cross_p.shape[2]-1-line_cross_p[..., ::-1].argmax(axis=2)
+    n_cross_n=line_cross_n.sum(axis=2)
+    first_n=line_cross_n.argmax(axis=2)
+
+    # If number of nan in the year is max_missing or more then PTDs are nan, the days before the first row do not count
+    active=selected & (nan.sum(axis=1)-padding.sum(axis=1)-s<max_missing)
+
+    #CASE 1: If threshold line crosses 2 points, normal case, sos<pos and eos>pos
+    case1=(n_cross==2) & (first<pos) & (last>pos)
+    #CASE 2: If threshold line crosses >=1 point before pos
+    case2=(n_cross>=1) & (last<pos)
+    #CASE 3: If threshold line crosses >=1 point after pos,
+    case3=(n_cross>=1) & (first>pos) & has_p
+    #CASE 4: If threshold line crosses >= 2 points, and pos is in between
+    case4=(n_cross>=2) & (first<pos) & (last>pos)
+
+    sos=np.full((n_thresholds, n_years), 9999) #false value
+    eos=np.full((n_thresholds, n_years), 9999) #false value
+
+    sos=np.where(case1, first+1, sos)
+    eos=np.where(case1, last+1, eos)
+
+    sos=np.where(case2, last+1, sos)
+    eos=np.where(case2 & (n_cross_n>=1), first_n+1, eos)
+
+    eos=np.where(case3, first+1, eos)
+    sos=np.where(case3 & (n_cross_p>=1), last_p+1, sos)
+
+    #the first crossing is before pos in case 4
+    sos=np.where(case4, first+1, sos)
+    eos=np.where(case4, first_after+1, eos)
+
+    # growing season length
+    found=(eos<9999) & (sos<9999)
+    gsl=np.full((n_thresholds, n_years), 9999)
+    gsl=np.where(found & (sos<pos) & (eos>pos), eos-sos, gsl)
+    gsl=np.where(found & (sos<pos) & (eos<pos), days- sos + eos, gsl)
+    gsl=np.where(found & (sos>pos) & (eos>pos), eos + days[prev]-sos, gsl)
+
+    #SOS, EOS, GSL from first derivative method
+    der1=active & (sos<pos) & (eos>pos)
+    der2=active & case2
+    der3=active & case3
+    der4=active & case4
+    der2_n=der2 & (n_cross_n>=1)
+    der3_p=der3 & (n_cross_p>=1)
+
+    #errors of the derivative method, raised as for a single year
+    empty=(der1 | der2 | der3 | der4) & (n<2)
+
+    eos_der=np.full((n_thresholds, n_years), 9999)
+    sos_der=np.full((n_thresholds, n_years), 9999)
+
+    #the filtered derivative of each year from its first day, window of 101 days for CASE 1 to 3, 201 days
+    #for CASE 4. They do not depend on the threshold. Positions in Var_s are counted from day s+1
+    Var_s, n_s=_segment_rows(Var, starts+s, n-s)
+    Var_1der=_derivative_rows(Var_s, n_s, 101)
+    pos_end=np.minimum(pos, n)
+    sos_1der, empty_sos=_arg_rows(Var_1der, np.zeros(n_years, dtype=int), pos_end-s, np.argmax)
+    eos_1der, empty_eos=_arg_rows(Var_1der, pos-s, n-1-s, np.argmin)
+    eos_1der_all, empty_all=_arg_rows(Var_1der, np.zeros(n_years, dtype=int), n_s, np.argmin)
+    sos_1der=sos_1der+s
+    eos_1der_all=eos_1der_all+s
+
+    #CASE 1
+    sos_der=np.where(der1, sos_1der+1, sos_der)
+    eos_der=np.where(der1, eos_1der+1, eos_der)
+    empty|=der1 & (empty_sos | empty_eos)
+
+    #CASE 2
+    sos_der=np.where(der2, sos_1der+1, sos_der)
+    empty|=der2 & empty_sos
+
+    rows=np.flatnonzero(der2_n.any(axis=0))
+    if len(rows): # pos of year j to the next year
+        X, length=_segment_rows(Var, starts[rows]+pos[rows], np.maximum(n[rows]-1-pos[rows], 0), starts[nxt[rows]]+s[nxt[rows]],
+                                n[nxt[rows]]-s[nxt[rows]])
+        arg, empty_rows=_arg_rows(_derivative_rows(X, length, 101), pos[rows], length-1, np.argmin)
+        eos_der[:, rows]=np.where(der2_n[:, rows], arg + 1, eos_der[:, rows])
+        empty[:, rows]|=der2_n[:, rows] & (empty_rows | (length<2))
+
+    #CASE 3
+    eos_der=np.where(der3, eos_1der_all+1, eos_der)
+    empty|=der3 & empty_all
+
+    rows=np.flatnonzero(der3_p.any(axis=0))
+    if len(rows): #eos of previous year to pos of present year
+        eos_p=eos_1der_all[rows]+1-s[rows]
+        length_p=np.maximum(n[prev[rows]]-s[prev[rows]]-1-eos_p, 0)
+        X, length=_segment_rows(Var, starts[prev[rows]]+s[prev[rows]]+eos_p, length_p, starts[rows]+s[rows], pos_end[rows]-s[rows])
+        arg, empty_rows=_arg_rows(_derivative_rows(X, length, 101), np.zeros(len(rows), dtype=int), length, np.argmax)
+        sos_der[:, rows]=np.where(der3_p[:, rows], arg -length_p+s[rows], sos_der[:, rows])
+        empty[:, rows]|=der3_p[:, rows] & (empty_rows | (length<2))
+
+    #CASE 4
+    if der4.any():
+        Var_1der=_derivative_rows(Var_s, n_s, 201)
+        sos_4der, empty_sos=_arg_rows(Var_1der, np.zeros(n_years, dtype=int), pos_end-s, np.argmax)
+        eos_4der, empty_all=_arg_rows(Var_1der, np.zeros(n_years, dtype=int), n_s, np.argmin)
+        sos_der=np.where(der4, sos_4der+s+1, sos_der)
+        eos_der=np.where(der4, eos_4der+s+1, eos_der)
+        empty|=der4 & (empty_sos | empty_all)
+
+    if strict and (active & empty).any():
+        raise ValueError("attempt to get argmin of an empty sequence")
+
+    if _profiler is not None:
+        sites=None if site is None else site_key if site_names is None else np.asarray(site_names, dtype=object)[site_key]
+        _profiler._record_years(Var_Years, sites, threshold.ravel(), np.broadcast_to(active, n_cross.shape),
+                                (case1, case2, case3, case4), n_cross)
+
+    # growing season length
+    gsl_der=eos_der -sos_der
+    gsl_der=np.where(gsl_der<0, gsl_der+days, gsl_der)
+
+    #Correction for the order sos,pos,eos: EOS in the next year (eos<pos, CASE 2) is counted on from the
+    #days of the year and SOS in the previous year (sos>pos, CASE 3) is negative. 9999 is kept
+    eos=np.where((eos<=pos) & (eos<9999), eos+days, eos)
+    sos=np.where((sos>=pos) & (sos<9999), sos-days[prev], sos)
+
+    pos=np.broadcast_to(pos, (n_thresholds, n_years))
+    active=active & ~empty
+    ptd[active]=np.stack([sos, pos, eos, gsl, sos_der, eos_der, gsl_der], axis=-1)[active]
+
+    return Var_Years, ptd if np.ndim(Threshold_value) else ptd[0]
+
+
+
+@_staged
+def _phenology_frame(Var_Years, ptd, site=None, site_name='site', Threshold_value=None):
+
+    '''
+
+    Builds df_pheno_out from the PTDs of all years at once, the default value 9999 is replaced by nan.
+
+    Parameters
+    ----------
+    Var_Years : the year of each row
+    ptd : array of shape (rows, 7) with "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der", "GSL_der",
+          or (thresholds, rows, 7) for a sequence of thresholds
+    site : the site of each row, added as first column with name site_name if given
+    Threshold_value : the sequence of thresholds, added as column "Threshold" if ptd has a threshold axis.
+                      The rows of the first threshold come first
+
+    '''
+
+    ptd_columns=["SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der"]
+
+    #PTDs are whole days, they are integers unless some years are nan
+    if not np.isnan(ptd).any():
+        ptd=ptd.astype('int64')
+
+    columns={} if site is None else {site_name: site}
+
+    #one block of rows for each threshold
+    if ptd.ndim==3:
+        columns={column: np.tile(values, len(ptd)) for column, values in columns.items()}
+        columns["Threshold"]=np.repeat(np.asarray(Threshold_value, dtype=float), ptd.shape[1])
+        Var_Years=np.tile(Var_Years, len(ptd))
+        ptd=ptd.reshape(-1, 7)
+
+    columns["Year"]=Var_Years
+    for i, column in enumerate(ptd_columns):
+        columns[column]=ptd[:, i]
+
+    df_pheno_out=pd.DataFrame(columns)
+
+    #Replace default value of 9999 to nan
+    df_pheno_out[["Year"]+ptd_columns]=df_pheno_out[["Year"]+ptd_columns].replace({9999:np.nan})
+
+    return df_pheno_out
+
+
+
+def _gap_flags(year, doy, Var, Year, SOS, EOS, distance=5):
+
+    '''
+
+    Quality flags of the gaps of the input of one site, for the rows of df_pheno_out
+
+    Parameters
+    ----------
+    year, doy, Var : the input rows of the site
+    Year, SOS, EOS : the year and the threshold SOS and EOS of each row of df_pheno_out
+    distance : a gap touches SOS or EOS if it has a day within this number of days of it
+
+    Returns
+    -------
+    flags : dictionary with the arrays "missing_days" (missing values in the days of the year, the days without
+            a row count as missing), "longest_gap" (days of the longest run of missing values in the year),
+            "gap_SOS" and "gap_EOS" (True if a missing day is within distance days of SOS or EOS, also in the
+            previous or next year, and for days outside the record)
+
+    '''
+
+    Var_Years, index=_year_grid(year, doy)
+    valid=index>=0
+    missing=np.isnan(np.where(valid, Var[index], np.nan))
+
+    #missing values in the span of each year, from its first to its last row
+    first=valid.argmax(axis=1)
+    last=366-valid[:, ::-1].argmax(axis=1)
+    gaps=missing & (np.arange(366)>=first[:, None]) & (np.arange(366)<last[:, None])
+
+    #longest run of missing values, each year ends with a day that is not missing
+    flat=np.concatenate([gaps, np.zeros((len(gaps), 1), dtype=bool)], axis=1).ravel()
+    ends=np.flatnonzero(~flat)
+    longest=np.zeros(len(gaps), dtype='int64')
+    np.maximum.at(longest, ends//367, np.diff(np.r_[-1, ends])-1)
+
+    #missing days on a continuous calendar, the record is padded with distance missing days on both sides
+    start=(Var_Years-1970).astype('datetime64[Y]').astype('datetime64[D]')
+    offset=(start-start[0]).astype('int64')
+    calendar=np.where((Var_Years%4==0) & ((Var_Years%100!=0) | (Var_Years%400==0)), 366, 365)
+    missing_days=np.ones(offset[-1]+calendar[-1]+2*distance, dtype=bool)
+    in_year=np.arange(366)<calendar[:, None]
+    missing_days[distance+(offset[:, None]+np.arange(366))[in_year]]=missing[in_year]
+    count=np.r_[0, np.cumsum(missing_days)]
+
+    j=np.searchsorted(Var_Years, Year)
+    flags={"missing_days": gaps.sum(axis=1)[j], "longest_gap": longest[j]}
+
+    for name, ptd in (("gap_SOS", SOS), ("gap_EOS", EOS)):
+        ptd=np.asarray(ptd, dtype=float)
+        found=~np.isnan(ptd)
+        day=distance+offset[j]+np.where(found, ptd, 1).astype('int64')-1
+        a=np.clip(day-distance, 0, len(missing_days))
+        b=np.clip(day+distance+1, 0, len(missing_days))
+        outside=(day-distance<0) | (day+distance+1>len(missing_days))
+        flags[name]=found & ((count[b]-count[a]>0) | outside)
+
+    return flags
+
+
+
+def _n_jobs(n_jobs):
+
+    '''
+
+    Number of worker processes, -1 uses all cores, -2 all cores but one and so on
+
+    '''
+
+    if n_jobs is None or n_jobs==0:
+        return 1
+
+    if n_jobs<0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+
+    return n_jobs
+
+
+
+def _share_arrays(arrays):
+
+    '''
+
+    Copies numpy arrays to shared memory, so that worker processes read them without pickling
+
+    Returns
+    -------
+    shared : the shared memory blocks, to be closed and unlinked by the caller
+    specs : (name, shape, dtype) of each array, to attach them in the workers with _attach_arrays
+
+    '''
+
+    shared=[]
+    specs=[]
+
+    for array in arrays:
+        array=np.ascontiguousarray(array)
+        shm=shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...]=array
+        shared.append(shm)
+        specs.append((shm.name, array.shape, array.dtype.str))
+
+    return shared, specs
+
+
+
+def _attach_arrays(specs):
+
+    '''
+
+    Attaches the shared arrays of _share_arrays in a worker process
+
+    '''
+
+    shared=[]
+    arrays=[]
+
+    for name, shape, dtype in specs:
+        shm=shared_memory.SharedMemory(name=name)
+        shared.append(shm)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+    return shared, arrays
+
+
+
+def _batch_worker(specs, k0, k1, Threshold_value, Smoothing, knots, backend, padding, gap_fill, max_missing):
+
+    '''
+
+    Worker of EasyPhenology_batch, _batch_sites on the shared arrays
+
+    '''
+
+    shared, arrays=_attach_arrays(specs)
+
+    try:
+        return _batch_sites(*arrays, k0, k1, Threshold_value, Smoothing, knots, backend, padding=padding, gap_fill=gap_fill,
+                            max_missing=max_missing)
+    finally:
+        del arrays
+        for shm in shared:
+            shm.close()
+
+
+
+def _batch_compute(year, doy, Var, site_order, site_starts, site_names, Threshold_value, Smoothing, knots, backend, padding, n_jobs,
+                   gap_fill='linear', max_missing=50):
+
+    '''
+
+    Smoothing and PTDs of the sites of EasyPhenology_batch, in one process or in chunks of sites in n_jobs processes
+
+    Returns
+    -------
+    results : list with the results of _batch_sites for each chunk of sites
+
+    '''
+
+    n_jobs=_n_jobs(n_jobs)
+
+    if n_jobs==1:
+        return [_batch_sites(year, doy, Var, site_order, site_starts, 0, len(site_names), Threshold_value, Smoothing, knots, backend,
+                             site_names, padding, gap_fill, max_missing)]
+
+    #Chunks of sites with about the same number of rows, the arrays are given to the workers in shared memory
+    n_chunks=min(len(site_names), 4*n_jobs)
+    bounds=np.unique(np.searchsorted(site_starts, np.linspace(0, site_starts[-1], n_chunks+1)))
+    bounds[0], bounds[-1]=0, len(site_names)
+
+    shared, specs=_share_arrays([year, doy, Var, site_order, site_starts])
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures=[executor.submit(_batch_worker, specs, k0, k1, Threshold_value, Smoothing, knots, backend, padding, gap_fill,
+                                     max_missing)
+                     for k0, k1 in zip(bounds[:-1], bounds[1:]) if k1>k0]
+            #results in the order of the sites, whatever the order in which the chunks finish
+            return [future.result() for future in futures]
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+
+
+def _store_sites(store, results, names, keys, site_rows, site_codes, codes):
+
+    '''
+
+    Writes the results of _batch_compute to the store, one entry for each site
+
+    Parameters
+    ----------
+    names, keys, site_rows : name, key and rows of each computed site, in the order of the results
+    site_codes : the site code of each row of the input
+    codes : the site code of each computed site
+
+    '''
+
+    k=0
+    for rows, Var_smooth, Var_Years, ptd, n_years, knots_sites in results:
+
+        #the smoothed rows of each site of the chunk, the rows are in the order of the sites
+        position=np.zeros(site_codes.max()+1, dtype=int)
+        position[codes[k:k+len(n_years)]]=np.arange(len(n_years))
+        bounds=np.r_[0, np.cumsum(np.bincount(position[site_codes[rows]], minlength=len(n_years)))]
+        years=np.r_[0, np.cumsum(n_years)]
+
+        for i in range(len(n_years)):
+            store.write(names[k+i], keys[k+i], np.searchsorted(site_rows[k+i], rows[bounds[i]:bounds[i+1]]),
+                        Var_smooth[bounds[i]:bounds[i+1]], Var_Years[years[i]:years[i+1]], ptd[..., years[i]:years[i+1], :],
+                        knots_sites[i])
+        k+=len(n_years)
+
+
+
+def _batch_sites(year, doy, Var, site_order, site_starts, k0, k1, Threshold_value, Smoothing, knots, backend, site_names=None,
+                 padding=20, gap_fill='linear', max_missing=50, strict=True):
+
+    '''
+
+    Smoothing and PTDs of the sites k0 to k1-1 of EasyPhenology_batch. site_names are the names of
+    all sites, used to label the years of a PhenologyProfile, padding, gap_fill and max_missing are those
+    of _smoothing_windows. With strict False a site with a smoothing window that can not be filled (nan
+    at the start of the window, or only nan with gap_fill 'climatology') gets nan PTDs and smoothed values
+    and the years for which the derivative method fails get nan PTDs, instead of an error
+
+    Returns
+    -------
+    rows : row positions of the smoothed values
+    Var_smooth : the smoothed values
+    Var_Years, ptd : year and PTDs of each site and year, see _phenology_site
+    n_years : number of years of each site
+    knots_sites : number of knots of each site
+
+    '''
+
+    site_rows=[]
+    windows=[]
+    climatology=[] if gap_fill == 'climatology' else None
+    smoothed=[]
+    days=[]
+    rows_smooth=[]
+    knots_windows=[]
+    knots_sites=np.full(k1-k0, knots if knots != "auto" else 0)
+    window_sites=[]
+
+    if Smoothing in ("True", "False"):
+        _check_backend(backend)
+
+    for k in range(k0, k1):  # Loop over sites, collect the padded windows of all sites
+        #stage of the site in an active PhenologyProfile, the smoothing and the PTDs of all sites together are not
+        #stages of a site
+        with _stage('site', k if site_names is None else site_names[k]):
+            rows_k=site_order[site_starts[k]:site_starts[k+1]]
+            site_rows.append(rows_k)
+
+            if Smoothing in ("True", "False"):
+                windows_k, rows_k_smooth, smoothed_k, days_k, climatology_k=_smoothing_windows(year[rows_k], doy[rows_k],
+                                                                                              Var[rows_k], padding, gap_fill,
+                                                                                              max_missing)
+                smoothed.append([i + len(windows) if i>=0 else -1 for i in smoothed_k])
+                days.append(days_k)
+                windows.extend(np.where(window>=0, rows_k[window], -1) for window in windows_k)
+                if climatology is not None:
+                    climatology.extend(climatology_k)
+                rows_smooth.append([np.where(r>=0, rows_k[r], -1) for r in rows_k_smooth])
+
+                #number of knots of the site chosen by generalized cross-validation, from the padded windows of the years
+                if knots == "auto":
+                    windows_auto, climatology_auto=windows_k, climatology_k
+                    if padding is None:
+                        windows_auto, climatology_auto=_smoothing_windows(year[rows_k], doy[rows_k], Var[rows_k], 20, gap_fill,
+                                                                          max_missing)[::4]
+                    knots_sites[k-k0]=_auto_knots([_window_values(Var[rows_k], window) for window in windows_auto],
+                                                  Smoothing == "True", climatology=climatology_auto)
+                knots_windows.extend([knots_sites[k-k0]]*len(windows_k))
+                window_sites.extend([k-k0]*len(windows_k))
+
+    #sites that can not be smoothed, only looked for if they do not raise an error
+    failed=np.zeros(k1-k0, dtype=bool)
+
+    #Smooth the windows of all sites together
+    if Smoothing in ("True", "False"):
+        values=[_window_values(Var, window) for window in windows]
+        if not strict and values:
+            if climatology is None:
+                unfilled=np.array([np.isnan(window[0]) for window in values])
+            else:
+                unfilled=np.array([np.isnan(window).all() for window in values])
+            failed[np.asarray(window_sites)[unfilled]]=True
+
+        if failed.any():
+            #the windows of the failed sites are nan, the others are smoothed
+            keep=np.flatnonzero(~failed[window_sites])
+            smooth=[np.full(len(window), np.nan) for window in values]
+            smooth_keep=_smooth_windows([values[i] for i in keep], [knots_windows[i] for i in keep], Smoothing == "True",
+                                        backend, padding is None, None if climatology is None else [climatology[i] for i in keep])
+            for i, Var_smooth in zip(keep, smooth_keep):
+                smooth[i]=Var_smooth
+        else:
+            smooth=_smooth_windows(values, knots_windows, Smoothing == "True", backend, padding is None, climatology)
+
+    rows_out=[]
+    Var_out=[]
+    year_ptd=[]
+    doy_ptd=[]
+    Var_ptd=[]
+
+    for k in range(k1-k0):  # Loop over sites, collect the values of the PTDs
+
+        if Smoothing in ("True", "False"):
+            #the PTDs are computed from all days of the years, the output has the days with a row
+            rows_k=np.concatenate(rows_smooth[k])
+            Var_k=_smoothed_values(smooth, rows_smooth[k], smoothed[k], days[k])
+            year_k, doy_k=_span_days(rows_smooth[k], year, doy)
+            present=rows_k>=0
+            rows_out.append(rows_k[present])
+            Var_out.append(Var_k[present])
+        else:
+            # Take the raw Var
+            rows_k=site_rows[k]
+            Var_k=Var[rows_k]
+            year_k, doy_k=year[rows_k], doy[rows_k]
+            rows_out.append(rows_k)
+            Var_out.append(Var_k)
+
+        year_ptd.append(year_k)
+        doy_ptd.append(doy_k)
+        Var_ptd.append(Var_k)
+
+    #PTDs of the years of all sites in one call of the kernel, each site with its own first and last year
+    site_ptd=np.repeat(np.arange(k1-k0), [len(year_k) for year_k in year_ptd])
+    ptd_rows=~failed[site_ptd]
+    Var_Years, ptd=_phenology_site(np.concatenate(year_ptd)[ptd_rows], np.concatenate(doy_ptd)[ptd_rows],
+                                   np.concatenate(Var_ptd)[ptd_rows], Threshold_value, site=site_ptd[ptd_rows], strict=strict,
+                                   max_missing=max_missing, site_names=np.arange(k0, k1) if site_names is None else site_names[k0:k1])
+
+    #number of years of each site, the rows of ptd are sorted by site and year
+    n_years=np.array([len(np.unique(year_k)) for year_k in year_ptd], dtype=int)
+
+    #the years of the failed sites have nan PTDs
+    if failed.any():
+        ptd_sites=ptd
+        Var_Years=np.concatenate([np.unique(year_k) for year_k in year_ptd])
+        ptd=np.full(ptd_sites.shape[:-2] + (len(Var_Years), 7), np.nan)
+        ptd[..., np.repeat(~failed, n_years), :]=ptd_sites
+
+    return np.concatenate(rows_out), np.concatenate(Var_out), Var_Years, ptd, n_years, knots_sites
+
+
+
+@_staged
+def EasyPhenology_batch(df, Threshold_value, Smoothing, knots, site='site', time=None, backend='spline', n_jobs=1, store=None,
+                        padding=20, gap_fill='linear', max_missing=50, quality=False):
+
+    '''
+
+    Produces phenological transition dates (PTDs) for many sites or pixels in one call
+
+    This function gives the same results as calling EasyPhenology for each site, but the
+    smoothing of all sites is done together. The input is either a long-format dataframe
+    with columns site, 'time', 'year', 'doy' and 'Var', or a 2-D array with the daily values
+    of Var for sites x days together with the dates of the days.
+
+    Parameters
+    ----------
+    df : a dataframe with columns : site, time, year, doy, Var or an array of shape (sites, days)
+    Threshold_value : the fixed percentage of the annual maximum, from 0 to 1, or a sequence of them
+    Smoothing : 'True' for integral smoothing, 'False' for direct smoothing
+    knots : number of knots of the spline, recommended 8 to 15, or "auto" to choose it from 8 to 15 by generalized
+            cross-validation for each site, reported in the column "knots"
+    site : name of the column with the site, for an array the site is its row number
+    time : dates of the days, required if df is an array
+    backend : 'spline', 'projection', 'whittaker', 'savgol', 'harmonic' or a function, see integral_smoothing
+    n_jobs : number of processes, -1 uses all cores. Chunks of sites are processed in parallel
+             and the results are the same as with n_jobs=1
+    padding : days added before and after each year for the smoothing, or None for the whole record, see integral_smoothing
+    gap_fill, max_missing : filling of the missing values and number of missing values from which a year is not smoothed
+                            and has nan PTDs, see integral_smoothing
+    quality : if True df_pheno_out has the quality flags of the gaps of each site and year, see EasyPhenology
+    store : a PhenologyStore. The results of sites whose input and parameters are unchanged are read from the
+            store without recomputation, the others are computed and written to it. The smoothed Var is kept
+            in float32 in the store, so df_smooth differs from a run without store by the float32 rounding
+
+    Returns
+    -------
+    df_pheno_out: the dataframe with columns site, "Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der",
+                  and "Threshold" after site for a sequence of thresholds
+    df_smooth : the dataframe with columns site, time, year, doy and Var, where Var is the smoothed values
+
+    '''
+
+    #Long-format dataframe from an array of sites x days
+    if not isinstance(df, pd.DataFrame):
+        Var_array=np.asarray(df, dtype=float)
+        time=pd.DatetimeIndex(time)
+        df=pd.DataFrame({site: np.repeat(np.arange(Var_array.shape[0]), Var_array.shape[1]),
+                         'time': np.tile(time, Var_array.shape[0]),
+                         'year': np.tile(time.year.to_numpy(dtype='int64'), Var_array.shape[0]),
+                         'doy': np.tile(time.dayofyear.to_numpy(dtype='int64'), Var_array.shape[0]),
+                         'Var': Var_array.ravel()})
+
+    year=df['year'].to_numpy()
+    doy=df['doy'].to_numpy()
+    Var=df['Var'].to_numpy(dtype=float)
+
+    #Rows of each site, sites in the order they first appear
+    site_codes, site_names=pd.factorize(df[site])
+    site_order=np.argsort(site_codes, kind='stable')
+    site_starts=np.searchsorted(site_codes[site_order], np.arange(len(site_names)+1))
+
+    if store is None:
+        results=_batch_compute(year, doy, Var, site_order, site_starts, site_names, Threshold_value, Smoothing, knots, backend,
+                               padding, n_jobs, gap_fill, max_missing)
+
+    else:
+        #Sites with a result in the store for the same input and parameters are read, the others are computed
+        #and written to the store. The results of all sites are read from the store, so that a rerun gives
+        #the same df_smooth as the first run
+        site_rows=[site_order[site_starts[k]:site_starts[k+1]] for k in range(len(site_names))]
+        keys=[store.key(year[rows_k], doy[rows_k], Var[rows_k], Threshold_value, Smoothing, knots, backend, padding, gap_fill,
+                        max_missing)
+              for rows_k in site_rows]
+        missing=[k for k in range(len(site_names)) if (site_names[k], keys[k]) not in store]
+
+        if missing:
+            order_m=np.concatenate([site_rows[k] for k in missing])
+            starts_m=np.r_[0, np.cumsum([len(site_rows[k]) for k in missing])]
+            results=_batch_compute(year, doy, Var, order_m, starts_m, site_names[missing], Threshold_value, Smoothing, knots,
+                                   backend, padding, n_jobs, gap_fill, max_missing)
+            _store_sites(store, results, [site_names[k] for k in missing], [keys[k] for k in missing],
+                         [site_rows[k] for k in missing], site_codes, np.asarray(missing))
+
+        results=[]
+        for k in range(len(site_names)):
+            arrays=store.arrays(site_names[k], keys[k])
+            ptd=arrays['ptd'].astype(float)
+            ptd[arrays['ptd']==store.missing]=np.nan
+            results.append((site_rows[k][arrays['rows']], arrays['Var'].astype(float), arrays['Year'].astype('int64'),
+                            ptd, [len(arrays['Year'])], arrays['knots'].astype('int64')))
+
+    rows_out, Var_out, Years_out, ptd_out, n_years, knots_out=zip(*results)
+    rows_out, Var_out, Years_out, n_years, knots_out=(np.concatenate(result)
+                                                      for result in (rows_out, Var_out, Years_out, n_years, knots_out))
+    ptd_out=np.concatenate(ptd_out, axis=-2)
+
+    site_out=np.repeat(np.asarray(site_names), n_years)
+    df_pheno_out=_phenology_frame(Years_out, ptd_out, site_out, site, Threshold_value)
+
+    #Report the number of knots of each site chosen by generalized cross-validation
+    if knots == "auto" and Smoothing in ("True", "False"):
+        df_pheno_out['knots']=np.tile(np.repeat(knots_out, n_years), len(df_pheno_out)//max(len(Years_out), 1))
+
+    #Quality flags of the gaps of each site and year, the rows of a site are found in each block of a threshold
+    if quality:
+        flags={}
+        bounds=np.r_[0, np.cumsum(n_years)]
+        for k in range(len(site_names)):
+            rows_k=site_order[site_starts[k]:site_starts[k+1]]
+            out_k=(np.arange(0, len(df_pheno_out), max(len(Years_out), 1))[:, None] + np.arange(bounds[k], bounds[k+1])).ravel()
+            for column, values in _gap_flags(year[rows_k], doy[rows_k], Var[rows_k], Years_out[out_k % len(Years_out)],
+                                             df_pheno_out['SOS'].to_numpy()[out_k], df_pheno_out['EOS'].to_numpy()[out_k]).items():
+                flags.setdefault(column, np.zeros(len(df_pheno_out), dtype=values.dtype))[out_k]=values
+        for column, values in flags.items():
+            df_pheno_out[column]=values
+
+    #The dataframe with smoothed Var
+    df_smooth=df.iloc[rows_out].copy()
+    df_smooth['Var']=Var_out
+
+    return df_pheno_out, df_smooth
+
+
+
+def _uncertainty_replicates(setup, n_replicates, seed):
+
+    '''
+
+    PTDs of n_replicates replicates of one site for EasyPhenology_uncertainty
+
+    The replicates are the fitted values plus resampled residuals (method 'residual') or plus normal
+    noise with the standard deviation of the residuals (method 'noise'). The nan values of Var are kept,
+    so every replicate is gap-filled at the same days. The windows of all years and replicates are smoothed
+    together by _smooth_windows with the backend of the data, backend 'spline' with the projection matrix of
+    the same spline, and the PTDs of all replicates are computed in one call of _phenology_site.
+
+    Parameters
+    ----------
+    setup : dictionary with the arrays of the site prepared by EasyPhenology_uncertainty
+    n_replicates : number of replicates
+    seed : seed of the random numbers
+
+    Returns
+    -------
+    ptd : array of shape (replicates, years, 7), corrected for the order sos,pos,eos and with nan for 9999
+
+    '''
+
+    rng=np.random.default_rng(seed)
+
+    Var=setup['Var']
+    perturb=setup['perturb']
+    residual=setup['residual']
+
+    #replicates of Var, days that are nan or not smoothed are not perturbed
+    Var_r=np.broadcast_to(Var, (n_replicates, len(Var))).copy()
+    if setup['method'] == 'residual':
+        Var_r[:, perturb]=setup['fitted'][perturb] + rng.choice(residual, size=(n_replicates, perturb.sum()))
+    else:
+        Var_r[:, perturb]=setup['fitted'][perturb] + rng.normal(0, residual.std(), size=(n_replicates, perturb.sum()))
+
+    #windows of all replicates, replicate by replicate, smoothed together
+    windows=setup['windows']
+    climatology=setup['climatology']
+    backend='projection' if setup['backend'] == 'spline' else setup['backend']
+    smooth=_smooth_windows([_window_values(Var_r[r], window) for r in range(n_replicates) for window in windows],
+                           setup['knots'], setup['integral'], backend, setup['record'],
+                           None if climatology is None else climatology*n_replicates)
+
+    Var_smooth=np.full((n_replicates, len(setup['rows'])), np.nan)
+    for r in range(n_replicates):
+        for i, days, out in zip(setup['smoothed'], setup['days'], setup['out']):
+            Var_smooth[r, out]=smooth[r*len(windows)+i][days]
+
+    #PTDs of all replicates at once, each replicate is a site
+    Var_Years, ptd=_phenology_site(np.tile(setup['year'], n_replicates), np.tile(setup['doy'], n_replicates),
+                                   Var_smooth.ravel(), setup['Threshold_value'],
+                                   site=np.repeat(np.arange(n_replicates), len(setup['rows'])), strict=False,
+                                   max_missing=setup['max_missing'])
+
+    ptd=ptd.reshape(n_replicates, -1, 7)
+    ptd[ptd==9999]=np.nan
+
+    return ptd
+
+
+
+@_staged
+def EasyPhenology_uncertainty(df, Threshold_value, Smoothing, knots, n_replicates=200, method='residual', interval=95,
+                              seed=None, chunk_size=100, n_jobs=1, backend='spline', padding=20, gap_fill='linear',
+                              max_missing=50):
+
+    '''
+
+    Percentile intervals of the phenological transition dates (PTDs) by bootstrap of the smoothing residuals
+
+    Var is smoothed as in EasyPhenology and the residuals of the smoothing are computed. Each replicate is
+    the smoothed Var plus residuals drawn with replacement (method='residual') or plus normal noise with the
+    standard deviation of the residuals (method='noise'). The replicates are smoothed together with the same
+    backend, padding and gap filling and their PTDs are computed together, chunk_size replicates at a time.
+    With backend 'spline' the replicates are smoothed with the projection matrix of the same spline, equal to
+    the least squares fit up to rounding.
+
+    Parameters
+    ----------
+    df : a dataframe with columns : time, year, doy, Var
+    Threshold_value : the fixed percentage of the annual maximum, from 0 to 1
+    Smoothing : 'True' for integral smoothing, 'False' for direct smoothing
+    knots : number of knots of the spline, recommended 8 to 15, or "auto", see integral_smoothing
+    n_replicates : number of replicates
+    method : 'residual' or 'noise'
+    interval : the width of the percentile interval in percent, 95 gives the 2.5 and 97.5 percentiles
+    seed : seed of the random numbers, for reproducible intervals with the same chunk_size
+    chunk_size : number of replicates processed together, the memory used grows with it
+    n_jobs : number of processes, -1 uses all cores. Chunks of replicates are processed in parallel
+    backend, padding, gap_fill, max_missing : see EasyPhenology
+
+    Returns
+    -------
+    df_uncertainty : the dataframe with columns "Year", "Method" ('threshold' or 'derivative'), "PTD" ("SOS",
+                     "POS", "EOS" or "GSL"), "estimate" the PTD of the data as in EasyPhenology, "lower",
+                     "median" and "upper" the percentiles of the replicates and "n" the number of replicates
+                     with this PTD
+
+    '''
+
+    if Smoothing not in ("True", "False"):
+        raise ValueError("Smoothing must be 'True' or 'False', the residuals are those of the smoothing")
+    if np.ndim(Threshold_value):
+        raise ValueError("Threshold_value must be a single value")
+    if method not in ('residual', 'noise'):
+        raise ValueError("method must be 'residual' or 'noise'")
+
+    year=df['year'].to_numpy()
+    doy=df['doy'].to_numpy()
+    Var=df['Var'].to_numpy(dtype=float)
+    integral=Smoothing == "True"
+
+    _check_backend(backend)
+
+    #Smooth the data
+    windows, rows, smoothed, days, climatology=_smoothing_windows(year, doy, Var, padding, gap_fill, max_missing)
+    if knots == "auto":
+        if padding is None:
+            windows_auto, climatology_auto=_smoothing_windows(year, doy, Var, 20, gap_fill, max_missing)[::4]
+            knots=_auto_knots([_window_values(Var, window) for window in windows_auto], integral, climatology=climatology_auto)
+        else:
+            knots=_auto_knots([_window_values(Var, window) for window in windows], integral, climatology=climatology)
+
+    smooth=_smooth_windows([_window_values(Var, window) for window in windows], knots, integral, backend, padding is None,
+                           climatology)
+    rows_smooth=np.concatenate(rows)
+    Var_smooth=_smoothed_values(smooth, rows, smoothed, days)
+    year_smooth, doy_smooth=_span_days(rows, year, doy)
+    present=rows_smooth>=0
+
+    #PTDs of the data
+    Var_Years, ptd=_phenology_site(year_smooth, doy_smooth, Var_smooth, Threshold_value, max_missing=max_missing)
+    ptd[ptd==9999]=np.nan
+
+    #fitted values and residuals of the days that are smoothed
+    fitted=np.full(len(Var), np.nan)
+    fitted[rows_smooth[present]]=Var_smooth[present]
+    perturb=~np.isnan(fitted) & ~np.isnan(Var)
+
+    #positions of the windows in the smoothed rows
+    offsets=np.cumsum([0]+[len(r) for r in rows])
+    setup={'year': year_smooth, 'doy': doy_smooth, 'rows': rows_smooth, 'Var': Var, 'fitted': fitted,
+           'perturb': perturb, 'residual': (Var-fitted)[perturb], 'method': method, 'integral': integral,
+           'knots': knots, 'Threshold_value': Threshold_value, 'backend': backend, 'record': padding is None,
+           'climatology': climatology, 'max_missing': max_missing, 'windows': windows,
+           'smoothed': [i for i in smoothed if i>=0], 'days': [d for d in days if d is not None],
+           'out': [np.arange(offsets[y], offsets[y+1]) for y, i in enumerate(smoothed) if i>=0]}
+
+    #chunks of replicates, each with its own random numbers
+    sizes=[min(chunk_size, n_replicates-start) for start in range(0, n_replicates, chunk_size)]
+    seeds=np.random.SeedSequence(seed).spawn(len(sizes))
+
+    n_jobs=_n_jobs(n_jobs)
+    if n_jobs==1:
+        ptd_r=[_uncertainty_replicates(setup, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures=[executor.submit(_uncertainty_replicates, setup, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+            ptd_r=[future.result() for future in futures]
+
+    ptd_r=np.concatenate(ptd_r)
+
+    #Percentiles of the replicates, years without PTDs in all replicates are nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        lower, median, upper=np.nanpercentile(ptd_r, [50-interval/2, 50, 50+interval/2], axis=0)
+
+    #Threshold and derivative PTDs, POS is the same for both methods
+    methods={'threshold': ["SOS", "POS", "EOS", "GSL"], 'derivative': ["SOS_der", "POS", "EOS_der", "GSL_der"]}
+    ptd_columns=["SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der"]
+
+    frames=[]
+    for name, columns in methods.items():
+        c=[ptd_columns.index(column) for column in columns]
+        frames.append(pd.DataFrame({"Year": np.repeat(Var_Years, 4), "Method": name,
+                                    "PTD": np.tile(["SOS", "POS", "EOS", "GSL"], len(Var_Years)),
+                                    "estimate": ptd[:, c].ravel(), "lower": lower[:, c].ravel(),
+                                    "median": median[:, c].ravel(), "upper": upper[:, c].ravel(),
+                                    "n": (~np.isnan(ptd_r[:, :, c])).sum(axis=0).ravel()}))
+
+    df_uncertainty=pd.concat(frames).sort_values("Year", kind="stable", ignore_index=True)
+
+    return df_uncertainty
+
+
+
+def _grid_tile(block, year, doy, Threshold_value, Smoothing, knots, backend, gap_fill='linear', max_missing=50):
+
+    '''
+
+    PTDs of the pixels of one tile of EasyPhenology_grid
+
+    Parameters
+    ----------
+    block : array of shape (pixels, days)
+    year, doy : year and doy of the days
+
+    Returns
+    -------
+    ptd : array of shape (pixels, years, 7), corrected for the order sos,pos,eos, nan for pixels
+          without data and for pixels that can not be smoothed (nan at the start of a smoothing window),
+          and for the years for which the derivative method fails
+
+    '''
+
+    n_days=len(year)
+    n_years=len(np.unique(year))
+    ptd=np.full((block.shape[0], n_years, 7), np.nan)
+
+    #pixels with data, for example not in the sea
+    valid=np.flatnonzero(~np.isnan(block).all(axis=1))
+
+    #The failures of the data of single pixels are nan (strict False of _batch_sites), the errors of the
+    #arguments are raised
+    if len(valid):
+        Var=block[valid].ravel()
+        site_starts=np.arange(len(valid)+1)*n_days
+        result=_batch_sites(np.tile(year, len(valid)), np.tile(doy, len(valid)), Var, np.arange(len(Var)), site_starts, 0,
+                            len(valid), Threshold_value, Smoothing, knots, backend, gap_fill=gap_fill, max_missing=max_missing,
+                            strict=False)
+        ptd[valid]=result[3].reshape(len(valid), n_years, 7)
+
+    ptd[ptd==9999]=np.nan
+
+    return ptd
+
+
+
+@_staged
+def EasyPhenology_grid(cube, time, Threshold_value, Smoothing, knots, out_dir, tile=(64, 64), backend='spline', gap_fill='linear',
+                       max_missing=50):
+
+    '''
+
+    Produces rasters of phenological transition dates (PTDs) for a gridded time series larger than memory
+
+    The input is a cube of daily values with shape (days, lat, lon), for example satellite GPP or LAI. It can
+    be the path of a .npy file, which is opened memory-mapped, or any array that is read with slices such as
+    a numpy memmap, a zarr array or a netCDF4 variable. The cube is read one spatial tile at a time and
+    the pixels of the tile are processed as in EasyPhenology_batch, so the memory used depends on the
+    tile size and not on the size of the cube.
+
+    The PTDs are written to memory-mapped .npy files in out_dir, one file for each of "SOS", "POS", "EOS",
+    "GSL", "SOS_der", "EOS_der" and "GSL_der" with shape (years, lat, lon), and the years are in Year.npy.
+    The file done.npy records the tiles that are finished and params.json the parameters of the run. If the run
+    is interrupted, calling the function again with the same out_dir and parameters continues with the tiles
+    that are not finished. Calling it with other parameters, dates or cube shape raises a ValueError, the
+    output of a different run has to be removed or written to another out_dir. Invalid arguments (backend,
+    gap_fill, knots) raise a ValueError before anything is written to out_dir. A pixel that can not be
+    smoothed, with nan at the start of a smoothing window, has nan PTDs, and the years of a pixel for which
+    the derivative method fails have nan PTDs.
+
+    Parameters
+    ----------
+    cube : array of shape (days, lat, lon) or the path of a .npy file
+    time : dates of the days
+    Threshold_value : the fixed percentage of the annual maximum, from 0 to 1
+    Smoothing : 'True' for integral smoothing, 'False' for direct smoothing
+    knots : number of knots of the spline, recommended 8 to 15
+    out_dir : directory of the output files
+    tile : number of lat and lon pixels of a tile
+    backend : 'spline', 'projection', 'whittaker', 'savgol', 'harmonic' or a function, see integral_smoothing
+    gap_fill, max_missing : filling of the missing values and number of missing values from which a year is not
+                            smoothed, see integral_smoothing. With 'climatology' and a larger max_missing more
+                            years of pixels with cloud gaps are kept
+
+    Returns
+    -------
+    rasters : dictionary with the years in "Year" and the PTD rasters "SOS", "POS", "EOS", "GSL",
+              "SOS_der", "EOS_der","GSL_der", opened read-only from out_dir. Pixels and years without
+              PTDs are nan
+
+    '''
+
+    ptd_columns=["SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der"]
+
+    if isinstance(cube, (str, os.PathLike)):
+        cube=np.load(cube, mmap_mode='r')
+
+    time=pd.DatetimeIndex(time)
+    year=time.year.to_numpy(dtype='int64')
+    doy=time.dayofyear.to_numpy(dtype='int64')
+    Var_Years=np.unique(year)
+
+    n_days, n_lat, n_lon=cube.shape
+    if n_days!=len(time):
+        raise ValueError("the first dimension of cube must be the days in time")
+
+    #The arguments are checked before anything is written to out_dir, by smoothing a pixel of zeros with the days
+    #of time. A run that fails here can be started again with other arguments
+    if gap_fill not in ('linear', 'climatology'):
+        raise ValueError("gap_fill must be 'linear' or 'climatology'")
+    if Smoothing in ("True", "False"):
+        windows=_smoothing_windows(year, doy, np.zeros(n_days), 20, gap_fill, max_missing)[0]
+        _smooth_windows([np.zeros(len(window)) for window in windows], knots if knots != "auto" else 8, Smoothing == "True",
+                        backend)
+
+    tiles=(-(-n_lat//tile[0]), -(-n_lon//tile[1]))
+    done_file=os.path.join(out_dir, 'done.npy')
+    params_file=os.path.join(out_dir, 'params.json')
+
+    #Parameters of the run, a run is only continued with the same parameters. A function given as backend is
+    #identified as in PhenologyStore, or by its name if its closure can not be hashed
+    try:
+        backend_key=_backend_key(backend)
+    except ValueError:
+        backend_key=f"{getattr(backend, '__module__', '')}.{getattr(backend, '__qualname__', type(backend).__name__)}"
+    params={'Threshold_value': np.asarray(Threshold_value, dtype=float).tolist(), 'Smoothing': str(Smoothing),
+            'knots': str(knots), 'backend': backend_key, 'gap_fill': gap_fill, 'max_missing': int(max_missing),
+            'tile': [int(size) for size in tile], 'shape': [n_days, n_lat, n_lon],
+            'time': hashlib.blake2b(np.stack([year, doy]).tobytes(), digest_size=16).hexdigest()}
+
+    #Continue an interrupted run, or create the output files filled with nan
+    if os.path.exists(done_file):
+        if not os.path.exists(params_file):
+            raise ValueError("out_dir contains the output of a run without params.json, its parameters can not be checked")
+        with open(params_file, encoding='utf-8') as file:
+            params_run=json.load(file)
+        changed=sorted(name for name in params.keys() | params_run.keys() if params.get(name)!=params_run.get(name))
+        if changed:
+            raise ValueError(f"out_dir contains the output of a run with other {', '.join(changed)}, remove it or use "
+                             "another out_dir")
+        done=np.load(done_file, mmap_mode='r+')
+        rasters={column: np.load(os.path.join(out_dir, column+'.npy'), mmap_mode='r+') for column in ptd_columns}
+
+    else:
+        os.makedirs(out_dir, exist_ok=True)
+        with open(params_file, 'w', encoding='utf-8') as file:
+            json.dump(params, file, indent=1)
+        np.save(os.path.join(out_dir, 'Year.npy'), Var_Years)
+        rasters={}
+        for column in ptd_columns:
+            rasters[column]=np.lib.format.open_memmap(os.path.join(out_dir, column+'.npy'), mode='w+',
+                                                      dtype='float32', shape=(len(Var_Years), n_lat, n_lon))
+            rasters[column][:]=np.nan
+            rasters[column].flush()
+        #done is created last, so that an interrupted creation is started again
+        done=np.lib.format.open_memmap(done_file, mode='w+', dtype=bool, shape=tiles)
+
+    for i, j in zip(*np.nonzero(~np.asarray(done))):  # Loop over tiles that are not finished
+
+        lat=slice(i*tile[0], min((i+1)*tile[0], n_lat))
+        lon=slice(j*tile[1], min((j+1)*tile[1], n_lon))
+
+        #pixels x days of the tile
+        block=np.asarray(cube[:, lat, lon], dtype=float)
+        ny, nx=block.shape[1:]
+        block=block.reshape(n_days, ny*nx).T
+
+        ptd=_grid_tile(block, year, doy, Threshold_value, Smoothing, knots, backend, gap_fill, max_missing)
+        ptd=ptd.reshape(ny, nx, len(Var_Years), 7).transpose(2, 0, 1, 3)
+
+        for c, column in enumerate(ptd_columns):
+            rasters[column][:, lat, lon]=ptd[..., c]
+            rasters[column].flush()
+
+        #the tile is marked as finished after its PTDs are written
+        done[i, j]=True
+        done.flush()
+
+    del rasters, done
+
+    rasters={"Year": Var_Years}
+    for column in ptd_columns:
+        rasters[column]=np.load(os.path.join(out_dir, column+'.npy'), mmap_mode='r')
+
+    return rasters
+
+
+
+@_staged
+def daily_aggregate(source, time='time', Var='Var', samples_per_day=None, how='mean', min_coverage=0.5, chunksize=100000,
+                    time_format=None, **read_options):
+
+    '''
+
+    Aggregates sub-daily values, for example half-hourly GPP of eddy covariance, to the daily input of EasyPhenology
+
+    The source is read one chunk at a time and only the sums and counts of the days are kept, so the memory
+    does not grow with the number of sub-daily values. A day can be split over two chunks and the chunks do
+    not have to be in time order. The output has a row for every day from the first to the last day, days
+    without any value have a nan Var. It can be given directly to integral_smoothing, direct_smoothing,
+    EasyPhenology and EasyPhenology_batch. The gap counts decide which days are missing: a day with less
+    than min_coverage of its samples has a nan Var and counts in the filter of years with 50 or more
+    missing days, a day with enough samples counts as complete.
+
+    Parameters
+    ----------
+    source : path of a CSV file, read with pandas.read_csv in chunks of chunksize rows; path of a .npy file
+             with a structured array with fields time and Var, memory-mapped; a dataframe; or an iterable of
+             dataframes (chunks) with columns time and Var
+    time : name of the column with the date and time of each value, the value belongs to the day of this time
+           (for FLUXNET files the start of the half hour, TIMESTAMP_START)
+    Var : name of the column with the variable of interest
+    samples_per_day : number of values in a complete day, 48 for half-hourly data. None infers it from the
+                      median time step of the first chunk
+    how : 'mean' for the daily mean of the valid values, 'sum' for the daily mean times samples_per_day,
+          the daily sum corrected for the missing values
+    min_coverage : the daily Var is nan if less than this fraction of the samples of the day is valid
+    chunksize : number of rows read at once
+    time_format : format of the time column, for example '%Y%m%d%H%M' for FLUXNET, None lets pandas infer it
+    read_options : other arguments of pandas.read_csv, for example na_values=[-9999]
+
+    Returns
+    -------
+    df : the dataframe with columns time, year, doy, Var, n and gaps, where n is the number of valid values of
+         the day and gaps the number of missing values, samples_per_day - n
+
+    '''
+
+    if how not in ('mean', 'sum'):
+        raise ValueError(f"how must be 'mean' or 'sum', not {how!r}")
+
+    #The chunks of the source
+    if isinstance(source, (str, os.PathLike)) and os.fspath(source).endswith('.npy'):
+        array=np.load(source, mmap_mode='r')
+        chunks=(pd.DataFrame({time: array[time][i:i+chunksize], Var: array[Var][i:i+chunksize]})
+                for i in range(0, len(array), chunksize))
+    elif isinstance(source, (str, os.PathLike)):
+        chunks=pd.read_csv(source, usecols=[time, Var], chunksize=chunksize, **read_options)
+    elif isinstance(source, pd.DataFrame):
+        chunks=(source.iloc[i:i+chunksize] for i in range(0, len(source), chunksize))
+    else:
+        chunks=source
+
+    #Sum and number of the valid values of the days of each chunk
+    days=[]
+    sums=[]
+    counts=[]
+
+    for chunk in chunks:
+        time_chunk=pd.to_datetime(chunk[time], format=time_format).to_numpy()
+        Var_chunk=chunk[Var].to_numpy(dtype=float)
+
+        keep=~np.isnat(time_chunk)
+        time_chunk, Var_chunk=time_chunk[keep], Var_chunk[keep]
+        if not len(time_chunk):
+            continue
+
+        #number of values in a complete day from the time step of the first chunk
+        if samples_per_day is None and len(time_chunk)>1:
+            step=np.median(np.diff(np.sort(time_chunk)))
+            samples_per_day=int(round(np.timedelta64(1, 'D')/step))
+
+        day_chunk, inverse=np.unique(time_chunk.astype('datetime64[D]'), return_inverse=True)
+        valid=~np.isnan(Var_chunk)
+        days.append(day_chunk)
+        sums.append(np.bincount(inverse, weights=np.where(valid, Var_chunk, 0), minlength=len(day_chunk)))
+        counts.append(np.bincount(inverse, weights=valid, minlength=len(day_chunk)))
+
+    if not days:
+        return pd.DataFrame({'time': pd.DatetimeIndex([]), 'year': np.array([], dtype='int64'),
+                             'doy': np.array([], dtype='int64'), 'Var': np.array([]),
+                             'n': np.array([], dtype='int64'), 'gaps': np.array([], dtype='int64')})
+
+    if samples_per_day is None:
+        raise ValueError("samples_per_day can not be inferred from a single value, give it")
+
+    #Days split over chunks are added together, then every day from the first to the last is a row
+    day, inverse=np.unique(np.concatenate(days), return_inverse=True)
+    position=(day-day[0]).astype(int)
+    n_days=position[-1]+1
+    Var_sum=np.zeros(n_days)
+    n=np.zeros(n_days, dtype='int64')
+    Var_sum[position]=np.bincount(inverse, weights=np.concatenate(sums))
+    n[position]=np.bincount(inverse, weights=np.concatenate(counts)).astype('int64')
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Var_day=Var_sum/n
+    Var_day[n<min_coverage*samples_per_day]=np.nan
+    if how == 'sum':
+        Var_day=Var_day*samples_per_day
+
+    time_day=pd.DatetimeIndex((day[0] + np.arange(n_days)).astype('datetime64[ns]'))
+
+    return pd.DataFrame({'time': time_day, 'year': time_day.year.to_numpy(dtype='int64'),
+                         'doy': time_day.dayofyear.to_numpy(dtype='int64'), 'Var': Var_day,
+                         'n': n, 'gaps': np.maximum(samples_per_day-n, 0)})
+
+
+
+@_staged
+def _season_peaks(x, site_starts, min_prominence):
+
+    '''
+
+    Peaks and troughs of the seasons of the continuous daily series of one or more sites
+
+    The series x has the sites one after the other, each between two separator days, and its nan values
+    and separators are set below the smallest value. Every peak with at least min_prominence is the POS of
+    a season. The troughs of a season are the minima between its peak and the previous and the next peak
+    (or the first and last day of the site), found for all seasons together with ufunc.reduceat.
+
+    Parameters
+    ----------
+    x : the series
+    site_starts : positions of the separators, the first and last day of x are separators
+    min_prominence : array with the minimal prominence of a peak at each day
+
+    Returns
+    -------
+    pos, left, right : positions in x of the peak and of the left and right trough of every season
+
+    '''
+
+    from scipy.signal import find_peaks
+
+    n=len(x)
+    position=np.arange(n)
+    pos=find_peaks(x, prominence=(min_prominence, None))[0]
+
+    if not len(pos):
+        return (np.array([], dtype='int64'),)*3
+
+    #troughs, the minima of the segments between the peaks and the separators
+    cuts=np.unique(np.r_[pos, pos+1, site_starts, site_starts+1])
+    cuts=cuts[cuts<n]
+    segment=np.searchsorted(cuts, position, side='right')-1
+    minimum=np.minimum.reduceat(x, cuts)
+    trough=np.minimum.reduceat(np.where(x==minimum[segment], position, n), cuts)
+    s=np.searchsorted(cuts, pos)
+
+    return pos, trough[s-1], trough[s+1]
+
+
+
+def _season_kernel(x, nan, pos, left, right, Threshold_value, Var_1der):
+
+    '''
+
+    PTDs of the seasons of _season_peaks, in time linear in the length of the series
+
+    The level of the rise is the trough plus Threshold_value times the amplitude of the rise, and SOS the
+    day before the first day of the rise above it, the day of the crossing as in EasyPhenology. EOS is the
+    last day of the fall to the right trough above the same fraction of the fall. SOS_der and EOS_der are
+    the days of the largest and smallest filtered derivative Var_1der in the rise and the fall, found with
+    _arg_rows as in EasyPhenology. The crossings of all seasons are evaluated together with ufunc.reduceat.
+
+    Parameters
+    ----------
+    x : the series of _season_peaks
+    nan : True for the nan values and the separators of x
+    pos, left, right : the peaks and troughs of the seasons, see _season_peaks
+    Threshold_value : a single threshold from 0 to 1
+    Var_1der : the filtered first derivative of x at each day, see EasyPhenology_seasons
+
+    Returns
+    -------
+    pos, sos, eos, sos_der, eos_der : positions in x, -1 if the PTD is not found because the rise or the
+                                      fall of the season has nan values
+
+    '''
+
+    n=len(x)
+    position=np.arange(n)
+
+    if not len(pos):
+        return (np.array([], dtype='int64'),)*5
+
+    #nan values in the rise and the fall
+    count=np.r_[0, np.cumsum(nan)]
+    rise_valid=count[pos+1]-count[left]==0
+    fall_valid=count[right+1]-count[pos]==0
+
+    result={}
+
+    for name, start, stop, base in (('rise', left, pos, left), ('fall', pos, right, right)):
+
+        #the rises (falls) of all seasons do not overlap, index of the season of each day or -1
+        season=np.searchsorted(start, position, side='right')-1
+        inside=(season>=0) & (position<=stop[np.maximum(season, 0)])
+        season=np.where(inside, season, 0)
+        bounds=np.minimum(np.ravel(np.column_stack([start, stop+1])), n-1)
+
+        level=x[base] + Threshold_value*(x[pos]-x[base])
+        above=inside & (x>=level[season])
+
+        if name == 'rise':
+            #day before the first day above the level, not before the trough
+            crossing=np.minimum.reduceat(np.where(above, position, n), bounds)[::2]
+            crossing=np.where(crossing<n, np.maximum(crossing-1, start), crossing)
+        else:
+            #last day above the level
+            crossing=np.maximum.reduceat(np.where(above, position, -1), bounds)[::2]
+
+        #day of the largest increase (decrease) of the derivative from start to stop
+        X, length=_segment_rows(Var_1der, start, stop-start+1)
+        derivative=start + _arg_rows(X, np.zeros(len(start), dtype=int), length, np.argmax if name == 'rise' else np.argmin)[0]
+        result[name]=(crossing, derivative)
+
+    sos, sos_der=(np.where(rise_valid & (values<n), values, -1) for values in result['rise'])
+    eos, eos_der=(np.where(fall_valid & (values<n), values, -1) for values in result['fall'])
+
+    return pos, sos, eos, sos_der, eos_der
+
+
+
+@_staged
+def EasyPhenology_seasons(df, Threshold_value, Smoothing, knots, prominence=0.3, site=None, backend='spline', padding=20,
+                          gap_fill='linear', max_missing=50):
+
+    '''
+
+    Produces the PTDs of every growing season, for sites with more than one season in a year
+
+    EasyPhenology finds one season in each year. Croplands with double cropping and savannas can have two
+    seasons (or more) in a year. This function smooths Var as EasyPhenology and then finds all peaks of the
+    smoothed series with scipy.signal.find_peaks. A peak is a season if its prominence is at least prominence
+    times the amplitude (maximum minus minimum) of Var in its year. Each season is bounded by the minima
+    (troughs) between its peak and the neighbouring peaks, also across the end of the year. SOS is the day
+    where Var crosses its left trough plus Threshold_value times the rise to POS (the last day below, the
+    crossing day of EasyPhenology), EOS the last day where Var is above its right trough plus Threshold_value
+    times the fall from POS. SOS_der and EOS_der are the days of the largest and smallest derivative in the
+    rise and in the fall, with the derivative of EasyPhenology: the gradient of each year filtered with a
+    Savitzky-Golay filter (_derivative_rows). The filter has 201 days, as in EasyPhenology, in a year with one
+    season. In a year with more seasons it has half the days of the shortest rise or fall of its seasons (at
+    least 5), because a filter longer than the season moves the days of the largest derivative by weeks. All
+    seasons of all sites are found together in time linear in the length of the record.
+
+    On a site with one season in every year POS, SOS_der and EOS_der are those of EasyPhenology, and SOS and
+    EOS as well where the troughs are the minima of the years. EasyPhenology takes the threshold of the minimum
+    and maximum of the year, so otherwise SOS and EOS can differ by a few days.
+
+    A season belongs to the year of its POS. SOS and EOS are days of year of that year, SOS in the previous
+    year is negative and EOS in the next year is after the last day of the year, as in EasyPhenology. The
+    PTDs of a season whose rise or fall has missing values (years that are not smoothed, the start and end
+    of the record) are nan.
+
+    Parameters
+    ----------
+    df : a dataframe with columns : time, year, doy, Var, and site if site is given
+    Threshold_value : the fixed percentage of the amplitude of the rise and the fall of a season, from 0 to 1,
+                      or a sequence of them
+    Smoothing : 'True' for integral smoothing, 'False' for direct smoothing, otherwise the raw Var
+    knots : number of knots of the spline, see integral_smoothing
+    prominence : the minimal prominence of a peak, as a fraction of the amplitude of Var in its year
+    site : name of the column with the site, None for a single site
+    backend, padding, gap_fill, max_missing : see integral_smoothing
+
+    Returns
+    -------
+    df_seasons : the dataframe with columns site (if site is given), "Threshold" (for a sequence of thresholds),
+                 "Year", "Season" (1 for the first season of the year, 2 for the second...), "SOS", "POS", "EOS",
+                 "GSL", "SOS_der", "EOS_der", "GSL_der", one row for each season
+    df_smooth : the dataframe with columns time, year, doy and Var, where Var is the smoothed values
+
+    '''
+
+    frames=[df] if site is None else [df_site for name, df_site in df.groupby(site, sort=False)]
+    names=[None] if site is None else [df_site[site].iloc[0] for df_site in frames]
+
+    #The continuous daily series of all sites, each site between two separator days
+    series=[np.array([np.nan])]
+    dates=[np.array(['NaT'], dtype='datetime64[D]')]
+    smooth_frames=[]
+
+    for name, df_site in zip(names, frames):
+        #stage of the site in an active PhenologyProfile, each site is smoothed on its own
+        with _stage('site', name):
+            if Smoothing in ("True", "False"):
+                df_smooth_site, (year, doy, Var)=_smooth_frame(df_site, knots, Smoothing == "True", backend, padding, gap_fill,
+                                                               max_missing)
+            else:
+                df_smooth_site=df_site
+                year, doy, Var=df_site['year'].to_numpy(), df_site['doy'].to_numpy(), df_site['Var'].to_numpy(dtype=float)
+            smooth_frames.append(df_smooth_site)
+
+            day=(np.asarray(year)-1970).astype('datetime64[Y]').astype('datetime64[D]') + (np.asarray(doy)-1)
+            first=day.min() if len(day) else np.datetime64('1970-01-01')
+            Var_site=np.full((day.max()-first).astype(int)+1 if len(day) else 0, np.nan)
+            Var_site[(day-first).astype(int)]=Var
+
+            series.extend([Var_site, np.array([np.nan])])
+            dates.extend([first + np.arange(len(Var_site)), np.array(['NaT'], dtype='datetime64[D]')])
+
+    Var_all=np.concatenate(series)
+    date=np.concatenate(dates)
+    nan=np.isnan(Var_all)
+    site_starts=np.flatnonzero(np.isnat(date))
+    site_code=np.cumsum(np.isnat(date))-1
+
+    #amplitude of each site and year, the minimal prominence of a peak on each day
+    year_all=np.where(np.isnat(date), 0, date.astype('datetime64[Y]').astype('int64')+1970)
+    key=site_code*10000 + year_all
+    starts=np.r_[0, np.flatnonzero(np.diff(key))+1]
+    amplitude=np.fmax.reduceat(Var_all, starts) - np.fmin.reduceat(Var_all, starts)
+    min_prominence=np.repeat(prominence*amplitude, np.diff(np.r_[starts, len(Var_all)]))
+    min_prominence[nan]=np.inf
+
+    #nan values and separators below all values, so that they are troughs and not peaks
+    floor=2*np.nanmin(Var_all) - np.nanmax(Var_all) - 1 if not nan.all() else 0
+    x=np.where(nan, floor, Var_all)
+    pos, left, right=_season_peaks(x, site_starts, min_prominence)
+
+    #Filter of the derivative of each site and year: 201 days as in EasyPhenology for a year with one season
+    #(or none), the odd number of days of half the shortest rise or fall for a year with more seasons
+    lengths=np.diff(np.r_[starts, len(Var_all)])
+    year_pos=np.searchsorted(starts, pos, side='right')-1
+    shortest=np.full(len(starts), len(Var_all))
+    np.minimum.at(shortest, year_pos, np.minimum(pos-left, right-pos))
+    window=np.maximum(shortest//2, 5)
+    window=np.where(np.bincount(year_pos, minlength=len(starts))>1, np.minimum(window-(window%2==0), 201), 201)
+
+    #filtered derivative of each site and year, the years with the same filter together. The separators are
+    #rows of one day without derivative
+    Var_1der=np.full(len(Var_all), np.nan)
+    for window_length in np.unique(window):
+        rows=np.flatnonzero(window==window_length)
+        X, length=_segment_rows(Var_all, starts[rows], lengths[rows])
+        X=_derivative_rows(X, length, window_length)
+        X[length<2]=np.nan
+        Var_1der[_segment_positions(starts[rows], lengths[rows])]=X[np.arange(X.shape[1])<length[:, None]]
+
+    thresholds=np.atleast_1d(np.asarray(Threshold_value, dtype=float))
+    ptd_columns=["SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der", "GSL_der"]
+    blocks=[]
+
+    for threshold in thresholds:
+        pos, sos, eos, sos_der, eos_der=_season_kernel(x, nan, pos, left, right, threshold, Var_1der)
+
+        #days of year relative to the first day of the year of POS, nan if not found
+        Year=year_all[pos]
+        first_day=(Year-1970).astype('datetime64[Y]').astype('datetime64[D]')
+        SOS, POS, EOS, SOS_der, EOS_der=(np.where(values>=0, (date[np.maximum(values, 0)]-first_day).astype('int64')+1, np.nan)
+                                         for values in (sos, pos, eos, sos_der, eos_der))
+
+        columns={} if site is None else {site: np.asarray(names, dtype=object)[site_code[pos]]}
+        if np.ndim(Threshold_value):
+            columns["Threshold"]=np.full(len(pos), threshold)
+        columns["Year"]=Year
+
+        #season number in the site and year, the peaks are in time order
+        group_start=np.r_[0, np.flatnonzero(np.diff(key[pos]))+1]
+        columns["Season"]=np.arange(len(pos)) - np.repeat(group_start, np.diff(np.r_[group_start, len(pos)])) + 1
+
+        for column, values in zip(ptd_columns, (SOS, POS, EOS, EOS-SOS, SOS_der, EOS_der, EOS_der-SOS_der)):
+            columns[column]=values
+
+        blocks.append(pd.DataFrame(columns))
+
+    df_seasons=pd.concat(blocks, ignore_index=True)
+
+    #PTDs are whole days, they are integers unless some are nan
+    for column in ptd_columns:
+        if not df_seasons[column].isna().any():
+            df_seasons[column]=df_seasons[column].astype('int64')
+
+    df_smooth=pd.concat(smooth_frames) if len(smooth_frames)>1 else smooth_frames[0]
+
+    return df_seasons, df_smooth
+
+
+
+class PhenologyStream:
+
+    '''
+
+    Incremental EasyPhenology for one site that receives new daily values
+
+    The stream keeps the raw and smoothed values and the PTDs of every year. When new days are added
+    with update, only the years that depend on them are smoothed again: the years with new days and
+    the year before, whose padding of 20 days comes from the next year. The PTDs are recomputed for
+    these years and the year before them, because SOS and EOS can be found in the previous or next
+    year. With padding None (whole-record windows) or gap_fill 'climatology' (the mean of all years)
+    every year depends on the new days, and all years are smoothed again and get new PTDs. The smoothed
+    values and the PTDs of the complete years are the same as EasyPhenology on all days received so far.
+    The last year is in df_pheno_out once its last day (31 December) is received, before that its
+    provisional SOS, POS and EOS are given by provisional.
+
+    Example
+    -------
+    stream=PhenologyStream(0.5, 'True', 10)
+    stream.update(df_history)
+    stream.update(df_today)   # df with the new days, columns time, year, doy, Var
+    df_pheno_out=stream.df_pheno_out
+    df_provisional=stream.provisional
+
+    Parameters
+    ----------
+    Threshold_value, Smoothing, knots, backend : see EasyPhenology, Threshold_value is a single value and
+    knots a number, "auto" would change the knots of the years already smoothed
+    padding, gap_fill, max_missing : see EasyPhenology
+
+    '''
+
+    def __init__(self, Threshold_value, Smoothing, knots, backend='spline', padding=20, gap_fill='linear', max_missing=50):
+
+        if np.ndim(Threshold_value) or knots == "auto":
+            raise ValueError("PhenologyStream requires a single Threshold_value and a number of knots")
+        if gap_fill not in ('linear', 'climatology'):
+            raise ValueError("gap_fill must be 'linear' or 'climatology'")
+
+        self.Threshold_value=Threshold_value
+        self.Smoothing=Smoothing
+        self.knots=knots
+        self.backend=backend
+        self.padding=padding
+        self.gap_fill=gap_fill
+        self.max_missing=max_missing
+
+        #raw values, smoothed values and PTDs of each year
+        self._raw={}
+        self._smooth={}
+        self._ptd={}
+
+
+    def update(self, df):
+
+        '''
+
+        Adds new days and updates the smoothed values and PTDs of the years that depend on them
+
+        Parameters
+        ----------
+        df : a dataframe with columns time, year, doy, Var of the new days, after the days already received
+
+        Returns
+        -------
+        self
+
+        '''
+
+        if len(df)==0:
+            return self
+
+        time=df['time'].to_numpy()
+        year=df['year'].to_numpy()
+
+        if self._raw:
+            last_year=max(self._raw)
+            if time[0]<=self._raw[last_year]['time'][-1] or year[0]<last_year:
+                raise ValueError("the new days must be after the days already received")
+
+        #Store the raw values of the new days, year by year
+        order, Years_new, starts, stops=_year_index(year)
+        for j, element in enumerate(Years_new):
+            rows=_year_rows(order, starts[j], stops[j])
+            new={'time': time[rows], 'doy': df['doy'].to_numpy()[rows], 'Var': df['Var'].to_numpy(dtype=float)[rows]}
+            if element in self._raw:
+                new={column: np.concatenate([self._raw[element][column], new[column]]) for column in new}
+            self._raw[element]=new
+
+        Var_Years=np.array(sorted(self._raw))
+        c=np.searchsorted(Var_Years, Years_new[0])
+
+        #whole-record windows and the climatology depend on all years, all years are updated
+        if self.Smoothing in ("True", "False") and (self.padding is None or self.gap_fill == 'climatology'):
+            c=0
+
+        #Smooth the years with new days and the year before, with one more year for the padding
+        self._update_smooth(Var_Years, max(c-1, 0))
+
+        #PTDs of the smoothed years and the year before
+        self._update_ptd(Var_Years, max(c-2, 0))
+
+        return self
+
+
+    def _update_smooth(self, Var_Years, first):
+
+        '''
+
+        Smoothed values of the years Var_Years[first:]
+
+        '''
+
+        Years_raw=Var_Years[max(first-1, 0):]
+        raw={column: np.concatenate([self._raw[y][column] for y in Years_raw]) for column in ('time', 'doy', 'Var')}
+        year=np.repeat(Years_raw, [len(self._raw[y]['Var']) for y in Years_raw])
+
+        if self.Smoothing not in ("True", "False"):
+            # Take the raw Var
+            for y in Var_Years[first:]:
+                self._smooth[y]={'time': self._raw[y]['time'], 'year': np.full(len(self._raw[y]['Var']), y),
+                                 'doy': self._raw[y]['doy'], 'Var': self._raw[y]['Var'],
+                                 'span_doy': self._raw[y]['doy'], 'span_Var': self._raw[y]['Var']}
+            return
+
+        windows, rows, smoothed, days, climatology=_smoothing_windows(year, raw['doy'], raw['Var'], self.padding, self.gap_fill,
+                                                                      self.max_missing)
+
+        #only the windows of the years to update are smoothed, a whole-record window once for all its years
+        skip=len(Years_raw)-len(Var_Years[first:])
+        keep=[i for i in dict.fromkeys(smoothed[skip:]) if i>=0]
+        smooth=_smooth_windows([_window_values(raw['Var'], windows[i]) for i in keep], self.knots, self.Smoothing == "True",
+                               self.backend, self.padding is None, None if climatology is None else [climatology[i] for i in keep])
+        smooth=dict(zip(keep, smooth))
+
+        #the rows of each year and, for the PTDs, all days of the year also without a row
+        for y, rows_y, i, days_y in zip(Var_Years[first:], rows[skip:], smoothed[skip:], days[skip:]):
+            Var_y=smooth[i][days_y] if i>=0 else np.full(len(rows_y), np.nan)
+            present=rows_y>=0
+            self._smooth[y]={'time': raw['time'][rows_y[present]], 'year': year[rows_y[present]], 'doy': raw['doy'][rows_y[present]],
+                             'Var': Var_y[present], 'span_doy': raw['doy'][rows_y[0]] + np.arange(len(rows_y)), 'span_Var': Var_y}
+
+
+    def _update_ptd(self, Var_Years, first):
+
+        '''
+
+        PTDs of the years Var_Years[first:]
+
+        '''
+
+        #smoothed rows of the years from two years before, so that the years before first are complete
+        Years_smooth=Var_Years[max(first-2, 0):]
+        year=np.repeat(Years_smooth, [len(self._smooth[y]['span_doy']) for y in Years_smooth])
+        doy=np.concatenate([self._smooth[y]['span_doy'] for y in Years_smooth])
+        Var=np.concatenate([self._smooth[y]['span_Var'] for y in Years_smooth])
+
+        #the last year is only used as next year until it is complete
+        last_year=Var_Years[-1]
+        complete=pd.Timestamp(self._raw[last_year]['time'][-1]).is_year_end
+        self._ptd.pop(last_year, None)
+
+        years=[j for j, y in enumerate(Years_smooth) if y>=Var_Years[first] and (complete or y<last_year)]
+
+        try:
+            Years_ptd, ptd=_phenology_site(year, doy, Var, self.Threshold_value, years, max_missing=self.max_missing)
+
+        except ValueError:
+            #the derivative search can fail while the next year has only a few days,
+            #these PTDs are nan until more days are received
+            if complete:
+                raise
+            ptd=np.full((len(Years_smooth), 7), np.nan)
+            for j in years:
+                try:
+                    ptd[j]=_phenology_site(year, doy, Var, self.Threshold_value, [j], max_missing=self.max_missing)[1][j]
+                except ValueError:
+                    pass
+
+        for j in years:
+            self._ptd[Years_smooth[j]]=ptd[j]
+
+
+    @property
+    def df_pheno_out(self):
+
+        '''
+
+        The dataframe with columns "Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der", as EasyPhenology
+
+        '''
+
+        Var_Years=np.array(sorted(self._ptd))
+        return _phenology_frame(Var_Years, np.array([self._ptd[y] for y in Var_Years]).reshape(-1, 7))
+
+
+    @property
+    def df_smooth(self):
+
+        '''
+
+        The dataframe with columns time, year, doy and Var, where Var is the smoothed values, as EasyPhenology
+
+        '''
+
+        Var_Years=sorted(self._smooth)
+        return pd.DataFrame({column: np.concatenate([self._smooth[y][column] for y in Var_Years])
+                             for column in ('time', 'year', 'doy', 'Var')})
+
+
+    @property
+    def provisional(self):
+
+        '''
+
+        Provisional SOS, POS and EOS of the last year while it is not complete
+
+        With the smoothed values received so far, normalized with their minimum and maximum, SOS is the
+        first day the threshold line is crossed upwards. POS is the day of the maximum once the values
+        decrease after it, and EOS the first day after POS on which the threshold line is crossed downwards.
+        PTDs that are not detectable yet are nan. These dates can still change with new days, the final
+        PTDs of the year are in df_pheno_out once the year is complete.
+
+        Returns
+        -------
+        df_provisional : dataframe with columns "Year", "SOS", "POS", "EOS" and "Days", the number of days received in the year
+
+        '''
+
+        last_year=max(self._smooth)
+        smooth=self._smooth[last_year]
+        Var=smooth['Var'][smooth['year']==last_year]
+        doy=smooth['doy'][smooth['year']==last_year]
+
+        sos=pos=eos=np.nan
+
+        if len(Var)>1 and not np.isnan(Var).all():
+            Var_n=(Var -np.nanmin(Var))/(np.nanmax(Var)-np.nanmin(Var))
+            above=Var_n>self.Threshold_value
+
+            #upward crossing of the threshold line
+            up=np.flatnonzero(~above[:-1] & above[1:])
+            if len(up)>=1:
+                sos=doy[up[0]+1]
+
+            #maximum that is followed by lower values
+            peak=np.nanargmax(Var)
+            if peak<len(Var)-1:
+                pos=doy[peak]
+
+                #downward crossing after the peak
+                down=np.flatnonzero(above[peak:-1] & ~above[peak+1:])
+                if len(down)>=1:
+                    eos=doy[peak+down[0]+1]
+
+        return pd.DataFrame({"Year": [last_year], "SOS": [sos], "POS": [pos], "EOS": [eos], "Days": [len(self._raw[last_year]['Var'])]})
+
+
+
+
+def _code_key(value, digest, seen=()):
+
+    '''
+
+    Adds the content of a value of a smoothing function (its code, constants, defaults, closure or an array)
+    to a hash, see _backend_key. seen are the functions being hashed, a recursive closure is hashed once
+
+    '''
+
+    if isinstance(value, types.CodeType):
+        digest.update(value.co_code)
+        digest.update(repr((value.co_names, value.co_varnames)).encode())
+        for const in value.co_consts:
+            _code_key(const, digest)
+    elif isinstance(value, types.FunctionType):
+        digest.update(f'{value.__module__}.{value.__qualname__}'.encode())
+        if id(value) in seen:
+            return
+        seen=(*seen, id(value))
+        _code_key(value.__code__, digest)
+        for default in (value.__defaults__ or ()) + tuple(sorted((value.__kwdefaults__ or {}).items())):
+            _code_key(default, digest, seen)
+        for cell in value.__closure__ or ():
+            try:
+                contents=cell.cell_contents
+            except ValueError:  # empty cell
+                digest.update(b'<empty>')
+                continue
+            _code_key(contents, digest, seen)
+    elif isinstance(value, functools.partial):
+        for item in (value.func, *value.args, *sorted(value.keywords.items())):
+            _code_key(item, digest, seen)
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype.str, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (tuple, list)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _code_key(item, digest, seen)
+    elif value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.generic)):
+        digest.update(repr(value).encode())
+    else:
+        raise ValueError(f"the store cannot identify the smoothing function by {type(value).__name__} {value!r}, "
+                         "use a function whose defaults and closure are numbers, strings, arrays or functions, or no store")
+
+
+
+def _backend_key(backend):
+
+    '''
+
+    Identifies the backend of the smoothing in the hash of a PhenologyStore entry: the name of a built-in backend,
+    or for a function the hash of its bytecode, constants, defaults and closure, so that two lambdas or closures
+    with different code or captured values get different entries. Global variables read by the function are not
+    part of the hash
+
+    '''
+
+    if isinstance(backend, str):
+        return backend
+
+    digest=hashlib.blake2b(digest_size=16)
+    _code_key(backend, digest)
+
+    return digest.hexdigest()
+
+
+
+class PhenologyStore:
+
+    '''
+
+    On-disk store of the smoothed values and PTDs of EasyPhenology_batch
+
+    Each site has one entry for each content hash of its input (year, doy and Var) and of the parameters
+    (Threshold_value, Smoothing, knots, backend, padding, gap_fill and max_missing). An entry is a directory
+    path/<site>/<hash> with one .npy file for each column, in compact types:
+
+         rows.npy : int32, position of the smoothed rows among the rows of the site in the input
+         Var.npy : float32, the smoothed Var
+         Year.npy : int16, the years
+         ptd.npy : int16, the PTDs as returned by _phenology_site, shape (years, 7) or
+                   (thresholds, years, 7), nan is stored as -32768
+         knots.npy : int16, the number of knots of the site
+
+    The files are opened memory-mapped, so reading an entry does not copy the data. An entry is written to a
+    temporary directory and renamed, so an interrupted run does not leave incomplete entries. The site is part
+    of the directory name as str(site), percent-encoded including the dots, sites with the same string share their
+    entries and an empty site name raises a ValueError.
+
+    Example
+    -------
+    store=PhenologyStore('results')
+    df_pheno_out, df_smooth=EasyPhenology_batch(df, 0.5, 'True', 10, store=store)   # computes and stores all sites
+    df_pheno_out, df_smooth=EasyPhenology_batch(df, 0.5, 'True', 10, store=store)   # reads all sites from the store
+
+    Parameters
+    ----------
+    path : directory of the store, created if it does not exist
+
+    '''
+
+    #version of the layout, part of the hash so that entries of another layout are not read
+    version=2
+    #int16 value of nan in ptd.npy
+    missing=-32768
+    columns=('rows', 'Var', 'Year', 'ptd', 'knots')
+
+    def __init__(self, path):
+
+        self.path=path
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, year, doy, Var, Threshold_value, Smoothing, knots, backend, padding=20, gap_fill='linear', max_missing=50):
+
+        '''
+
+        Content hash of the input of a site and the parameters of EasyPhenology_batch. A smoothing function
+        given as backend is hashed by its code, defaults and closure, see _backend_key
+
+        '''
+
+        digest=hashlib.blake2b(digest_size=16)
+        for values in (year, doy):
+            digest.update(np.ascontiguousarray(values, dtype='int64'))
+        digest.update(np.ascontiguousarray(Var, dtype='float64'))
+        digest.update(repr((self.version, np.ndim(Threshold_value), np.asarray(Threshold_value, dtype=float).tolist(),
+                            str(Smoothing), str(knots), _backend_key(backend), padding, gap_fill, max_missing)).encode())
+
+        return digest.hexdigest()
+
+    def _entry(self, site, key):
+
+        #the site name is percent-encoded with the dots, so that no site ('.', '..', '../x') gives a path outside
+        #of its directory of the store
+        name=urllib.parse.quote(str(site), safe='').replace('.', '%2E')
+        if not name:
+            raise ValueError("the sites of a PhenologyStore need a non-empty name")
+
+        return os.path.join(self.path, name, key)
+
+    def __contains__(self, site_key):
+
+        return os.path.isdir(self._entry(*site_key))
+
+    def arrays(self, site, key):
+
+        '''
+
+        The columns of an entry as memory-mapped arrays, see the layout above
+
+        '''
+
+        entry=self._entry(site, key)
+
+        return {column: np.load(os.path.join(entry, column + '.npy'), mmap_mode='r') for column in self.columns}
+
+    def write(self, site, key, rows, Var, Var_Years, ptd, knots):
+
+        '''
+
+        Writes the entry of a site, an existing entry of the same site and key is kept
+
+        '''
+
+        entry=self._entry(site, key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        arrays={'rows': np.asarray(rows, dtype='int32'), 'Var': np.asarray(Var, dtype='float32'),
+                'Year': np.asarray(Var_Years, dtype='int16'),
+                'ptd': np.where(np.isnan(ptd), self.missing, ptd).astype('int16'),
+                'knots': np.asarray([knots], dtype='int16')}
+
+        temporary=f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(temporary, exist_ok=True)
+        for column, values in arrays.items():
+            np.save(os.path.join(temporary, column + '.npy'), values)
+
+        try:
+            os.rename(temporary, entry)
+        except OSError:
+            #written by another run in the meantime
+            shutil.rmtree(temporary)
+
+    def sites(self):
+
+        '''
+
+        Dataframe of the entries with columns site, key and bytes (size of the files)
+
+        '''
+
+        entries=[]
+        for site in sorted(os.listdir(self.path)):
+            for key in sorted(os.listdir(os.path.join(self.path, site))):
+                if key.endswith('.tmp'):
+                    continue
+                entry=os.path.join(self.path, site, key)
+                entries.append((urllib.parse.unquote(site), key,
+                                sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))))
+
+        return pd.DataFrame(entries, columns=['site', 'key', 'bytes'])
+
+
+
+
+class PhenologyProfile:
+
+    '''
+
+    Opt-in instrumentation of EasyPhenology
+
+    While the profile is active (in a with block) every stage of the functions of this module records its
+    number of calls, wall time and peak allocated memory, and the PTD kernel records for each site, threshold
+    and year whether the year was computed, which of the CASE 1 to 4 of the threshold method apply and the
+    number of crossings of the threshold line. Without an active profile the stages are not recorded and
+    cost one check of a global variable.
+
+    The stages are nested: the stage of EasyPhenology contains the stages smooth_frame, smooth_windows,
+    spline, phenology_site, threshold, savgol and so on. A stage is identified by its path, the names of
+    the stages that contain it separated by ';', and by its site. The steps that EasyPhenology_batch and
+    EasyPhenology_seasons do for each site separately (the windows, the automatic knots, the smoothing of a
+    site of EasyPhenology_seasons) are in a stage 'site' with the name of the site, and the stages in it
+    have the same site. The smoothing and the PTD kernel of all sites and years together have no site, and
+    there is no time of a year, because the years are computed together; the years are recorded with
+    their cases instead. Stages run in worker processes (n_jobs>1) are recorded as one stage of the main
+    process.
+
+    Example
+    -------
+    with PhenologyProfile() as profile:
+        df_pheno_out, df_smooth=EasyPhenology(df, 0.5, 'True', 10)
+    profile.stages              # calls, time and memory of each stage
+    profile.cases               # number of years of CASE 1 to 4 for each year
+    profile.to_json('profile.json')
+    profile.to_folded('profile.folded')   # input of flamegraph.pl or speedscope
+
+    Parameters
+    ----------
+    memory : True to record the peak allocated memory of each stage with tracemalloc. tracemalloc
+             slows down numpy and pandas, so the times are larger than without memory
+
+    '''
+
+    def __init__(self, memory=True):
+
+        self.memory=memory
+        self._stack=[]
+        self._stages={}
+        self._years=[]
+        self._tracing=False
+
+    def __enter__(self):
+
+        global _profiler
+
+        if _profiler is not None:
+            raise RuntimeError("A PhenologyProfile is already active")
+
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing=True
+
+        _profiler=self
+        return self
+
+    def __exit__(self, *exc):
+
+        global _profiler
+
+        _profiler=None
+
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing=False
+
+    @contextlib.contextmanager
+    def _stage(self, name, site):
+
+        #the site of a stage is the site of the stage that contains it if it is not given
+        parent=self._stack[-1] if self._stack else None
+        if site is None and parent is not None:
+            site=parent['site']
+        path=name if parent is None else parent['path'] + ';' + name
+
+        #The peak memory of the stage is measured from the current memory, the peak reached so far
+        #is kept for the parent stage
+        memory=tracemalloc.is_tracing()
+        if memory:
+            current, peak=tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent['peak']=max(parent['peak'], peak)
+            tracemalloc.reset_peak()
+        else:
+            current=0
+
+        frame={'path': path, 'site': site, 'current': current, 'peak': current, 'children': 0.0}
+        self._stack.append(frame)
+        start=time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed=time.perf_counter()-start
+            self._stack.pop()
+
+            allocated=0
+            if memory and tracemalloc.is_tracing():
+                frame['peak']=max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                allocated=frame['peak']-current
+                if parent is not None:
+                    parent['peak']=max(parent['peak'], frame['peak'])
+            if parent is not None:
+                parent['children']+=elapsed
+
+            record=self._stages.setdefault((path, site), [0, 0.0, 0.0, 0])
+            record[0]+=1
+            record[1]+=elapsed
+            record[2]+=elapsed-frame['children']
+            record[3]=max(record[3], allocated)
+
+    def _record_years(self, Var_Years, site_key, threshold, active, cases, n_cross):
+
+        #sites of the years: the site codes of the kernel or the site of the current stage
+        if site_key is None:
+            site_key=np.full(len(Var_Years), self._stack[-1]['site'] if self._stack else None, dtype=object)
+
+        for t, threshold_t in enumerate(threshold):
+            self._years.append(pd.DataFrame({'site': site_key, 'Threshold': threshold_t, 'Year': Var_Years,
+                                             'computed': active[t],
+                                             **{f'CASE_{c+1}': case[t] for c, case in enumerate(cases)},
+                                             'crossings': n_cross[t]}))
+
+    @property
+    def stages(self):
+
+        '''
+
+        Dataframe with one row for each stage and site, columns stage (the path of the stage), site, calls,
+        time and self_time (time without the stages it contains) in seconds, and bytes (peak allocated memory
+        of a call of the stage, 0 without memory)
+
+        '''
+
+        df_stages=pd.DataFrame([(path, *record) for (path, site), record in self._stages.items()],
+                               columns=['stage', 'calls', 'time', 'self_time', 'bytes'])
+        #object column, so the site names are not converted to float if some stages have no site
+        df_stages.insert(1, 'site', pd.Series([site for path, site in self._stages], dtype=object))
+
+        return df_stages
+
+    @property
+    def years(self):
+
+        '''
+
+        Dataframe with one row for each call of the PTD kernel, site, threshold and year, columns site,
+        Threshold, Year, computed (False if the year has 50 or more nan), CASE_1 to CASE_4 and crossings.
+        The cases are checked one after the other as in EasyPhenology, so a year with two crossings around
+        pos is in CASE 1 and CASE 4
+
+        '''
+
+        if not self._years:
+            return pd.DataFrame(columns=['site', 'Threshold', 'Year', 'computed', 'CASE_1', 'CASE_2', 'CASE_3',
+                                         'CASE_4', 'crossings'])
+
+        return pd.concat(self._years, ignore_index=True)
+
+    @property
+    def cases(self):
+
+        '''
+
+        Number of the computed site-years of CASE 1 to 4 for each year
+
+        '''
+
+        years=self.years
+        columns=['CASE_1', 'CASE_2', 'CASE_3', 'CASE_4']
+        years[columns]=years[columns].astype(bool) & years['computed'].astype(bool).to_numpy()[:, None]
+
+        return years.groupby('Year')[columns].sum().astype(int)
+
+    def to_json(self, path):
+
+        '''
+
+        Writes the stages, the years and the cases to a JSON file
+
+        '''
+
+        profile={'stages': self.stages.to_dict(orient='records'),
+                 'years': self.years.to_dict(orient='records'),
+                 'cases': self.cases.reset_index().to_dict(orient='records')}
+
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(profile, file, indent=1, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+
+    def to_csv(self, path, years_path=None):
+
+        '''
+
+        Writes the stages to a CSV file and, if years_path is given, the years to a second CSV file
+
+        '''
+
+        self.stages.to_csv(path, index=False)
+
+        if years_path is not None:
+            self.years.to_csv(years_path, index=False)
+
+    def to_folded(self, path):
+
+        '''
+
+        Writes the stages as folded stacks, one line 'stage;stage;stage microseconds' for each stage, with the
+        self time in microseconds. The file is the input of
+        flamegraph.pl, speedscope and other flame-graph viewers
+
+        '''
+
+        with open(path, 'w', encoding='utf-8') as file:
+            for (stage, site), record in self._stages.items():
+                file.write(f"{stage} {round(1e6*record[2])}\n")
 
 
 
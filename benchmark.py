@@ -0,0 +1,775 @@
+#Benchmarks of EasyPhenology
+
+'''
+Benchmarks that guard EasyPhenology.py against performance regressions and changes of its results.
+
+Run all benchmarks with
+
+     python3 benchmark.py
+
+or single benchmarks with their names, for example python3 benchmark.py import golden
+
+     import : time to import EasyPhenology in a new python process. The import of numpy and pandas,
+              which EasyPhenology requires, is measured separately and subtracted. The benchmark fails
+              if the import of EasyPhenology itself takes longer than max_overhead seconds, for example
+              after a module that is slow to import (statsmodels, scipy.stats, tsmoothie) is imported
+              at the top of EasyPhenology.py again.
+
+     scenarios : time and peak memory of integral_smoothing, direct_smoothing, EasyPhenology and
+              EasyPhenology_batch on synthetic GPP of 10 and 40 years, 1 and 10 sites and 8 and 12 knots.
+
+     backends : time of EasyPhenology_batch with each smoothing backend ('spline', 'projection', 'whittaker',
+              'savgol', 'harmonic'), with padded years and with the whole record in one fit (padding=None), and the
+              agreement of the PTDs with those of the spline with padded years: the median absolute
+              difference in days and the percent of site-years within 5 days.
+
+     golden : PTDs of EasyPhenology on synthetic GPP (north, south and with long gaps) and on the years with
+              data of Data/df_input.pkl, compared with the PTDs of the original code stored in Data/golden_ptd.csv.
+              The PTDs that were changed on purpose are listed with the reason in Data/golden_changes.csv.
+              The benchmark fails if a PTD changed that is not listed or if a listed change is not found.
+
+     partial : PTDs of records that start after 1 January, compared with the PTDs of the same record from
+              1 January. The SOS and EOS of the partial first year must be within tolerance days and the
+              years from the third year on, which do not see the missing days in their smoothing, the same.
+
+     seasons : EasyPhenology_seasons on sites with one season in every year, compared with EasyPhenology. On a
+              record whose troughs are the minima of the years all PTDs must be the same. On synthetic GPP, where
+              the troughs of the seasons and the minima of the years differ, POS and the derivative PTDs must be
+              the same and SOS and EOS within tolerance days. On a record with two Gaussian seasons in every year
+              POS must be on the peaks and SOS_der and EOS_der within 2 days of the inflection points.
+
+     consistency : PTDs of EasyPhenology_batch, EasyPhenology_batch with a PhenologyStore, PhenologyStream,
+              EasyPhenology_grid and EasyPhenology_seasons on the records of the golden benchmark, compared with
+              EasyPhenology. The benchmark fails if a function gives other PTDs.
+
+     aggregate : daily_aggregate on a half-hourly CSV file with days split over chunks, values of -9999 (na_values)
+              and a day with too few values, compared with the daily mean of pandas groupby on the whole file.
+
+     uncertainty : EasyPhenology_uncertainty on synthetic GPP with the default options and with gap_fill 'climatology'.
+              The estimate must be the PTD of EasyPhenology and the intervals the same with n_jobs 1 and 2 for the
+              same seed and chunk_size.
+
+     golden-update : stores the PTDs of the current EasyPhenology.py that differ from Data/golden_ptd.csv in
+              Data/golden_changes.csv. Data/golden_ptd.csv, the output of the original code, is not changed.
+              Run it only when a change of the PTDs is intended and write the reason of each new change
+              (marked 'unexplained') into the file.
+
+The synthetic GPP of synthetic_gpp is reproducible: the same arguments give the same data.
+The script exits with status 1 if a benchmark fails.
+'''
+
+
+#import required libraries
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+import EasyPhenology as ep
+
+
+path=os.path.dirname(os.path.abspath(__file__))
+golden_file=os.path.join(path, 'Data', 'golden_ptd.csv')
+changes_file=os.path.join(path, 'Data', 'golden_changes.csv')
+
+
+def synthetic_gpp(start='1981-01-01', end='2020-12-31', n_sites=1, south=False, noise=1.0, gaps=0.02, seed=0):
+
+    '''
+
+    Synthetic daily GPP with a double logistic season in every year
+
+    Each season rises with a logistic curve around SOS and falls with a logistic curve around EOS. SOS, EOS,
+    the steepness of the curves and the amplitude change randomly from season to season. Normal noise
+    is added and gaps of 1 to 15 days are set to nan. The dates are a daily calendar, so leap years have
+    366 days. In the southern hemisphere the season is shifted by half a year and crosses the end of the
+    calendar year (SOS in the previous year or EOS in the next year).
+
+    Parameters
+    ----------
+    start, end : first and last day
+    n_sites : number of sites, each with its own seasons and noise
+    south : True for sites in the southern hemisphere
+    noise : standard deviation of the noise in gC m-2 d-1
+    gaps : fraction of the days in gaps. The first and last 30 days and the first days of the smoothing windows
+           (12 December, 20 days before the year) are not in gaps, because EasyPhenology can not interpolate
+           missing values at the start of a smoothing window
+    seed : seed of the random numbers
+
+    Returns
+    -------
+    df : dataframe with columns site, time, year, doy and Var, the sites one after the other
+
+    '''
+
+    rng=np.random.default_rng(seed)
+    time_days=pd.date_range(start, end, freq='D')
+
+    #day of the season year, which starts on 1 July in the southern hemisphere
+    season_time=time_days - pd.Timedelta(days=181) if south else time_days
+    season_year=season_time.year.to_numpy()
+    season_doy=season_time.dayofyear.to_numpy()
+    season_years, season=np.unique(season_year, return_inverse=True)
+
+    frames=[]
+    for k in range(n_sites):
+
+        #parameters of every season
+        sos=rng.normal(120, 10, len(season_years))
+        eos=rng.normal(280, 10, len(season_years))
+        rise=rng.uniform(6, 12, len(season_years))
+        fall=rng.uniform(8, 15, len(season_years))
+        amplitude=rng.uniform(8, 14, len(season_years))
+
+        Var=(amplitude[season] * (1/(1+np.exp(-(season_doy-sos[season])/rise[season]))
+                                  - 1/(1+np.exp(-(season_doy-eos[season])/fall[season])))
+             + 0.5 + rng.normal(0, noise, len(time_days)))
+        Var_season=Var.copy()
+
+        #gaps of 1 to 15 days
+        n_gaps=int(gaps*len(time_days)/8)
+        for gap_start, gap_length in zip(rng.integers(30, len(time_days)-45, n_gaps), rng.integers(1, 16, n_gaps)):
+            Var[gap_start:gap_start+gap_length]=np.nan
+        window_start=(time_days.month==12) & (time_days.day==12)
+        Var[window_start]=Var_season[window_start]
+
+        frames.append(pd.DataFrame({'site': k, 'time': time_days, 'year': time_days.year.to_numpy(dtype='int64'),
+                                    'doy': time_days.dayofyear.to_numpy(dtype='int64'), 'Var': Var}))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+
+def benchmark_import(repeat=7, max_overhead=0.25):
+
+    '''
+
+    Time to import EasyPhenology in a new python process
+
+    Parameters
+    ----------
+    repeat : number of new processes for each measurement, the median is used
+    max_overhead : maximum time in seconds of the import of EasyPhenology without numpy and pandas
+
+    Returns
+    -------
+    passed : True if the import of EasyPhenology took less than max_overhead seconds
+
+    '''
+
+    def import_time(statement):
+        times=[]
+        for i in range(repeat):
+            start=time.perf_counter()
+            subprocess.run([sys.executable, '-c', statement], check=True, cwd=path)
+            times.append(time.perf_counter()-start)
+        return statistics.median(times)
+
+    #python with numpy and pandas only, then with EasyPhenology
+    base=import_time('import numpy, pandas')
+    total=import_time('import EasyPhenology')
+    overhead=total-base
+
+    print(f"import          numpy+pandas {base:.3f} s, EasyPhenology {total:.3f} s, overhead {overhead:.3f} s (max {max_overhead} s)")
+
+    return overhead<=max_overhead
+
+
+
+def benchmark_scenarios(years=(10, 40), sites=(1, 10), knots=(8, 12), repeat=3):
+
+    '''
+
+    Time and peak memory of the smoothing and PTD functions on synthetic GPP
+
+    Each scenario is run repeat times and the fastest time is reported. The peak memory is measured with
+    tracemalloc in one more run, because tracemalloc slows down the run. integral_smoothing, direct_smoothing
+    and EasyPhenology are called for each site, EasyPhenology_batch for all sites at once.
+
+    Parameters
+    ----------
+    years, sites, knots : the numbers of years, sites and knots of the scenarios
+
+    Returns
+    -------
+    passed : always True, the times are printed
+
+    '''
+
+    functions={'integral_smoothing': lambda df, k: ep.integral_smoothing(df, k),
+               'direct_smoothing': lambda df, k: ep.direct_smoothing(df, k),
+               'EasyPhenology': lambda df, k: ep.EasyPhenology(df, 0.5, 'True', k)}
+
+    print(f"{'scenario':<20}{'years':>6}{'sites':>6}{'knots':>6}{'time (s)':>11}{'per site (ms)':>15}{'peak (MB)':>11}")
+
+    for n_years in years:
+        for n_sites in sites:
+            df=synthetic_gpp(start=f'{2021-n_years}-01-01', end='2020-12-31', n_sites=n_sites, seed=n_years)
+            df_sites=[df_site.drop(columns='site') for k, df_site in df.groupby('site')]
+
+            for n_knots in knots:
+                runs={name: (lambda function=function: [function(df_site, n_knots) for df_site in df_sites])
+                      for name, function in functions.items()}
+                runs['EasyPhenology_batch']=lambda: ep.EasyPhenology_batch(df, 0.5, 'True', n_knots)
+
+                for name, run in runs.items():
+                    times=[]
+                    for i in range(repeat):
+                        start=time.perf_counter()
+                        run()
+                        times.append(time.perf_counter()-start)
+
+                    tracemalloc.start()
+                    run()
+                    peak=tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+
+                    print(f"{name:<20}{n_years:>6}{n_sites:>6}{n_knots:>6}{min(times):>11.4f}"
+                          f"{1000*min(times)/n_sites:>15.2f}{peak/1e6:>11.1f}")
+
+    return True
+
+
+
+def benchmark_backends(n_years=20, n_sites=20, knots=10, repeat=3):
+
+    '''
+
+    Time and PTD agreement of the smoothing backends on synthetic GPP
+
+    Parameters
+    ----------
+    n_years, n_sites, knots : the numbers of years, sites and knots
+    repeat : number of runs of each backend, the fastest time is reported
+
+    Returns
+    -------
+    passed : always True, the times and differences are printed
+
+    '''
+
+    df=synthetic_gpp(start=f'{2021-n_years}-01-01', end='2020-12-31', n_sites=n_sites, seed=7)
+    columns=["SOS", "POS", "EOS", "SOS_der", "EOS_der"]
+    runs=[('spline', 20), ('spline', None), ('projection', 20), ('whittaker', 20), ('whittaker', None), ('savgol', 20), ('savgol', None),
+          ('harmonic', 20), ('harmonic', None)]
+
+    print(f"{'backend':<20}{'padding':>8}{'time (s)':>10}" + "".join(f"{column:>14}" for column in columns))
+
+    for Smoothing in ("True", "False"):
+        for backend, padding in runs:
+            times=[]
+            for i in range(repeat):
+                start=time.perf_counter()
+                df_pheno_out=ep.EasyPhenology_batch(df, 0.5, Smoothing, knots, backend=backend, padding=padding)[0]
+                times.append(time.perf_counter()-start)
+
+            #differences to the PTDs of the spline with padded years, median in days and percent within 5 days
+            if (backend, padding) == ('spline', 20):
+                reference=df_pheno_out[columns].to_numpy(dtype=float)
+            difference=np.abs(df_pheno_out[columns].to_numpy(dtype=float)-reference)
+            agreement=[f"{np.nanmedian(d):>6.1f} {100*np.mean(d<=5):>5.0f}%" for d in difference.T]
+
+            name=f"{backend} {'integral' if Smoothing == 'True' else 'direct'}"
+            print(f"{name:<20}{str(padding):>8}{min(times):>10.4f}" + "".join(f"{a:>14}" for a in agreement))
+
+    return True
+
+
+
+def golden_datasets():
+
+    '''
+
+    Records of the golden-output check: synthetic GPP of the northern and southern hemisphere with gaps and
+    leap years and the years 1996 to 2020 of Data/df_input.pkl
+
+    Returns
+    -------
+    datasets : dictionary of the dataframes with columns time, year, doy and Var by case name
+
+    '''
+
+    datasets={'north': synthetic_gpp(start='2000-01-01', end='2019-12-31', seed=1).drop(columns='site'),
+              'south': synthetic_gpp(start='2000-01-01', end='2019-12-31', south=True, seed=2).drop(columns='site'),
+              'gaps': synthetic_gpp(start='2003-01-01', end='2012-12-31', gaps=0.08, noise=2.0, seed=3).drop(columns='site')}
+
+    df=pd.read_pickle(os.path.join(path, 'Data', 'df_input.pkl'))
+    datasets['DE-Tha']=df[(df['year']>=1996) & (df['year']<=2020)].reset_index(drop=True)
+
+    return datasets
+
+
+
+def golden_ptd(module=ep):
+
+    '''
+
+    PTDs of EasyPhenology for the golden-output check
+
+    The cases are the records of golden_datasets with integral, direct and no smoothing, 8 and 12 knots and
+    the thresholds 0.3 and 0.5. Each threshold is computed in its own call, as the original EasyPhenology
+    takes a single threshold.
+
+    Parameters
+    ----------
+    module : the EasyPhenology module, for example the EasyPhenology.py of the first commit of the repository
+             loaded with importlib, which gives the PTDs of Data/golden_ptd.csv
+
+    Returns
+    -------
+    df_golden : dataframe with columns case, Smoothing, knots, Threshold, the columns of df_pheno_out and error.
+                A case for which EasyPhenology raises an error has one row with the error message in error
+
+    '''
+
+    columns=["Year", "SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der", "GSL_der"]
+
+    frames=[]
+    for case, df in golden_datasets().items():
+        for Smoothing in ("True", "False", "raw"):
+            for knots in (8, 12):
+                for Threshold in (0.3, 0.5):
+                    try:
+                        df_pheno_out=module.EasyPhenology(df.copy(), Threshold, Smoothing, knots)[0][columns]
+                        df_pheno_out=df_pheno_out.reset_index(drop=True)
+                        df_pheno_out['error']=''
+                    except ValueError as error:
+                        #an error of EasyPhenology is part of the golden output
+                        df_pheno_out=pd.DataFrame({'error': [str(error)]})
+                    df_pheno_out.insert(0, 'Threshold', Threshold)
+                    df_pheno_out.insert(0, 'knots', knots)
+                    df_pheno_out.insert(0, 'Smoothing', Smoothing)
+                    df_pheno_out.insert(0, 'case', case)
+                    frames.append(df_pheno_out)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+
+def golden_differences(df_new):
+
+    '''
+
+    PTDs of df_new (see golden_ptd) that differ from Data/golden_ptd.csv
+
+    Returns
+    -------
+    df_changes : dataframe with one row for each changed PTD, columns case, Smoothing, knots, Threshold, Year,
+                 PTD, golden (the PTD of the golden output) and new (the PTD of df_new), None if the cases,
+                 years or errors of df_new are not those of the golden output
+
+    '''
+
+    df_golden=pd.read_csv(golden_file, dtype={'Smoothing': str, 'error': str}).fillna({'error': ''})
+
+    columns=["SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der","GSL_der"]
+    keys=['case', 'Smoothing', 'knots', 'Threshold', 'Year']
+    if (df_new.shape!=df_golden.shape
+            or not df_new[keys+['error']].astype(str).equals(df_golden[keys+['error']].astype(str))):
+        return None
+
+    new=df_new[columns].to_numpy(dtype=float)
+    old=df_golden[columns].to_numpy(dtype=float)
+    row, column=np.nonzero(~((new==old) | (np.isnan(new) & np.isnan(old))))
+
+    df_changes=df_new.loc[row, keys].reset_index(drop=True)
+    df_changes['Year']=df_changes['Year'].astype('int64')
+    df_changes['PTD']=np.asarray(columns)[column]
+    df_changes['golden']=old[row, column]
+    df_changes['new']=new[row, column]
+
+    return df_changes
+
+
+
+def benchmark_golden():
+
+    '''
+
+    Compares the PTDs of the current EasyPhenology.py with Data/golden_ptd.csv, the PTDs of the original
+    EasyPhenology.py. The PTDs that differ must be the intended changes listed in Data/golden_changes.csv
+    with the same new value, each with the reason of the change
+
+    Returns
+    -------
+    passed : True if all PTDs are the same or intended changes, and all intended changes are found
+
+    '''
+
+    df_new=golden_ptd()
+    df_changes=golden_differences(df_new)
+
+    if df_changes is None:
+        print(f"golden          {len(df_new)} years, the cases, years or errors differ from {os.path.relpath(golden_file, path)}")
+        return False
+
+    df_intended=pd.read_csv(changes_file, dtype={'Smoothing': str})
+    keys=['case', 'Smoothing', 'knots', 'Threshold', 'Year', 'PTD', 'golden', 'new']
+    merged=df_changes.merge(df_intended, on=keys, how='outer', indicator=True)
+
+    #report the PTDs that changed without a reason and the intended changes that are not found
+    for _, change in merged[merged['_merge']!='both'].iterrows():
+        state='changed' if change['_merge'] == 'left_only' else 'intended change not found'
+        print(f"golden          {state} {change['case']} Smoothing={change['Smoothing']} knots={change['knots']} "
+              f"Threshold={change['Threshold']} Year={change['Year']} {change['PTD']}: {change['golden']} -> {change['new']}")
+
+    passed=bool((merged['_merge'] == 'both').all())
+    print(f"golden          {len(df_new)} years, {'same PTDs as' if passed else 'PTDs differ from'} "
+          f"{os.path.relpath(golden_file, path)} except the {len(df_intended)} intended changes of "
+          f"{os.path.relpath(changes_file, path)}")
+
+    return passed
+
+
+
+def benchmark_partial(starts=('2001-01-25', '2001-03-01'), tolerance=5):
+
+    '''
+
+    PTDs of records that start in the middle of the first year
+
+    The record of each start is the synthetic record from 1 January with the days before the start removed
+    (from the first valid value on or after the start, which can not be interpolated otherwise).
+
+    Parameters
+    ----------
+    starts : first days of the partial records
+    tolerance : maximum difference in days of SOS and EOS of the first year to those of the full record
+
+    Returns
+    -------
+    passed : True if SOS and EOS of the first year are within tolerance days and the years from the third
+             year on are the same for all starts, integral and direct smoothing
+
+    '''
+
+    df=synthetic_gpp(start='2001-01-01', end='2008-12-31', seed=4).drop(columns='site')
+    columns=["SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der", "GSL_der"]
+
+    passed=True
+    for start in starts:
+        first=df.loc[(df['time']>=start) & df['Var'].notna(), 'time'].min()
+        df_partial=df[df['time']>=first].reset_index(drop=True)
+
+        for Smoothing in ("True", "False"):
+            full=ep.EasyPhenology(df, [0.3, 0.5], Smoothing, 10)[0]
+            partial=ep.EasyPhenology(df_partial, [0.3, 0.5], Smoothing, 10)[0]
+
+            year1=(full['Year']==full['Year'].min()).to_numpy()
+            later=(full['Year']>=full['Year'].min()+2).to_numpy()
+            difference=np.abs(partial.loc[year1, ["SOS", "EOS"]].to_numpy(dtype=float)-full.loc[year1, ["SOS", "EOS"]].to_numpy(dtype=float))
+            same=partial.loc[later, columns].equals(full.loc[later, columns])
+            ok=len(partial)==len(full) and bool((difference<=tolerance).all()) and same
+            passed&=ok
+
+            print(f"partial         start {first.date()} Smoothing={Smoothing}: first year SOS/EOS within "
+                  f"{np.max(difference):.0f} days, later years {'same' if same else 'differ'}{'' if ok else ' FAILED'}")
+
+    return passed
+
+
+
+def benchmark_seasons(tolerance=5):
+
+    '''
+
+    PTDs of EasyPhenology_seasons on sites with one season in every year, compared with EasyPhenology, and
+    on a site with two seasons in every year, compared with the days of its curve
+
+    Parameters
+    ----------
+    tolerance : maximum difference in days of SOS and EOS on synthetic GPP
+
+    Returns
+    -------
+    passed : True if all PTDs are the same on the record with the troughs at the minima of the years, POS
+             and the derivative PTDs are the same and SOS and EOS within tolerance days on synthetic GPP,
+             and on the record with two seasons the seasons are found with POS on the peaks and SOS_der and
+             EOS_der within 2 days of the inflection points of the peaks
+
+    '''
+
+    columns=["SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der", "GSL_der"]
+
+    #one season in every year that rises from and falls to the same minimum on 1 January and 31 December,
+    #with random amplitude and asymmetry, so the troughs of the seasons are the minima of the years
+    rng=np.random.default_rng(5)
+    time_days=pd.date_range('2001-01-01', '2012-12-31', freq='D')
+    year=time_days.year.to_numpy()
+    doy=time_days.dayofyear.to_numpy()
+    length=np.where(time_days.is_leap_year, 366, 365)
+    amplitude=rng.uniform(5, 12, size=12)[year-2001]
+    shape=rng.uniform(0.6, 1.6, size=12)[year-2001]
+    Var=1 + amplitude*np.sin(np.pi*((doy-1)/(length-1))**shape)**2
+    df_single=pd.DataFrame({'time': time_days, 'year': year, 'doy': doy, 'Var': Var})
+
+    cases=[('troughs at the minima of the years', df_single, "raw", columns, 0),
+           ('synthetic GPP', synthetic_gpp(start='2001-01-01', end='2012-12-31', seed=1).drop(columns='site'), "True",
+            ["POS", "SOS_der", "EOS_der", "GSL_der"], tolerance)]
+
+    passed=True
+    for name, df, Smoothing, same_columns, days in cases:
+        single=ep.EasyPhenology(df, [0.3, 0.5], Smoothing, 10)[0]
+        seasons=ep.EasyPhenology_seasons(df, [0.3, 0.5], Smoothing, 10)[0]
+
+        ok=len(seasons)==len(single) and bool((seasons[['Threshold', 'Year']].to_numpy(dtype=float)
+                                                ==single[['Threshold', 'Year']].to_numpy(dtype=float)).all())
+        difference=np.zeros(1)
+        if ok:
+            same=seasons[same_columns].to_numpy(dtype=float)==single[same_columns].to_numpy(dtype=float)
+            difference=np.abs(seasons[["SOS", "EOS"]].to_numpy(dtype=float)-single[["SOS", "EOS"]].to_numpy(dtype=float))
+            ok=bool(same.all()) and bool((difference<=days).all())
+        passed&=ok
+
+        print(f"seasons         {name}: {len(seasons)} seasons, {', '.join(same_columns)} "
+              f"{'same' if ok else 'differ'}" + ("" if days==0 else f", SOS/EOS within {np.max(difference):.0f} days")
+              + ("" if ok else " FAILED"))
+
+    #two seasons in every year (double cropping), Gaussian peaks with random day, width and amplitude. The
+    #derivative is largest and smallest at the inflection points, a width before and after the peak
+    peak=np.column_stack([rng.integers(90, 121, size=12), rng.integers(230, 261, size=12)])
+    width=rng.uniform(10, 20, size=(12, 2))
+    height=rng.uniform(5, 10, size=(12, 2))
+    Var=1 + sum(height[year-2001, i]*np.exp(-0.5*((doy-peak[year-2001, i])/width[year-2001, i])**2) for i in range(2))
+    df_double=pd.DataFrame({'time': time_days, 'year': year, 'doy': doy, 'Var': Var})
+
+    seasons=ep.EasyPhenology_seasons(df_double, 0.5, "raw", 10)[0]
+    found=seasons.dropna(subset=["SOS_der", "EOS_der"])
+    i=np.asarray(found['Season'])-1
+    k=np.asarray(found['Year'])-2001
+    ok=(len(seasons)==24 and len(found)>=22 and bool((found['POS'].to_numpy()==peak[k, i]).all()))
+    difference=np.zeros(1)
+    if ok:
+        difference=np.abs(np.r_[found['SOS_der'].to_numpy()-(peak[k, i]-width[k, i]),
+                                found['EOS_der'].to_numpy()-(peak[k, i]+width[k, i])])
+        ok=bool((difference<=2).all())
+    passed&=ok
+
+    print(f"seasons         two seasons in a year: {len(seasons)} seasons, POS on the peaks, SOS_der/EOS_der within "
+          f"{np.max(difference):.1f} days of the inflection points" + ("" if ok else " FAILED"))
+
+    return passed
+
+
+
+def benchmark_consistency(Threshold_value=0.5, knots=8):
+
+    '''
+
+    PTDs of EasyPhenology_batch, EasyPhenology_batch with a PhenologyStore, PhenologyStream, EasyPhenology_grid
+    and EasyPhenology_seasons on the records of golden_datasets, compared with EasyPhenology, which the golden
+    check guards. The records for which EasyPhenology raises an error are left out.
+
+         batch : all records as the sites of one call, the PTDs of every site
+         store : the same call twice with a new store, computed and then read from the store
+         stream : the first half of each record and then 30 days at a time, the PTDs of the complete years
+         grid : the records of the same days (north and south) as the pixels of a cube of 1 x 2 pixels, the
+                PTDs in float32
+         seasons : the smoothed records with one season in every year (north), POS and the derivative PTDs;
+                   the raw records have several seasons in a year
+
+    Returns
+    -------
+    passed : True if the PTDs of all functions are those of EasyPhenology
+
+    '''
+
+    columns=["SOS", "POS", "EOS", "GSL", "SOS_der", "EOS_der", "GSL_der"]
+    datasets=golden_datasets()
+
+    def same(df_pheno_out, reference, columns=columns):
+        return (len(df_pheno_out)==len(reference)
+                and np.array_equal(df_pheno_out[["Year"]+columns].to_numpy(dtype=float),
+                                   reference[["Year"]+columns].to_numpy(dtype=float), equal_nan=True))
+
+    passed=True
+    for Smoothing in ("True", "False", "raw"):
+        reference={}
+        for case, df in datasets.items():
+            try:
+                reference[case]=ep.EasyPhenology(df, Threshold_value, Smoothing, knots)[0]
+            except ValueError:
+                pass
+
+        results={}
+
+        #batch and store, all records as sites of one call
+        df_sites=pd.concat([datasets[case].assign(site=case) for case in reference], ignore_index=True)
+        df_batch=ep.EasyPhenology_batch(df_sites, Threshold_value, Smoothing, knots)[0]
+        results['batch']=all(same(df_batch[df_batch['site']==case], reference[case]) for case in reference)
+
+        with tempfile.TemporaryDirectory() as directory:
+            store=ep.PhenologyStore(directory)
+            runs=[ep.EasyPhenology_batch(df_sites, Threshold_value, Smoothing, knots, store=store)[0] for _ in range(2)]
+        results['store']=all(same(df_run[df_run['site']==case], reference[case]) for df_run in runs for case in reference)
+
+        #stream, the complete years of the records
+        results['stream']=True
+        for case in reference:
+            df=datasets[case]
+            stream=ep.PhenologyStream(Threshold_value, Smoothing, knots)
+            stream.update(df.iloc[:len(df)//2])
+            for start in range(len(df)//2, len(df), 30):
+                stream.update(df.iloc[start:start+30])
+            df_stream=stream.df_pheno_out
+            results['stream']&=same(df_stream, reference[case][reference[case]['Year'].isin(df_stream['Year'])])
+
+        #grid, the records with the same days as pixels
+        pixels=[case for case in ('north', 'south') if case in reference]
+        if pixels:
+            cube=np.stack([datasets[case]['Var'].to_numpy(dtype=float) for case in pixels], axis=1)[:, None, :]
+            with tempfile.TemporaryDirectory() as directory:
+                rasters=ep.EasyPhenology_grid(cube, datasets[pixels[0]]['time'], Threshold_value, Smoothing, knots, directory,
+                                              tile=(1, 1))
+                results['grid']=all(np.array_equal(np.column_stack([rasters["Year"]]+[rasters[column][:, 0, i] for column in columns]),
+                                                   reference[case][["Year"]+columns].to_numpy(dtype='float32'), equal_nan=True)
+                                    for i, case in enumerate(pixels))
+                del rasters
+
+        #seasons, the records with one season in every year
+        if 'north' in reference and Smoothing!='raw':
+            df_seasons=ep.EasyPhenology_seasons(datasets['north'], Threshold_value, Smoothing, knots)[0]
+            results['seasons']=same(df_seasons, reference['north'], ["POS", "SOS_der", "EOS_der", "GSL_der"])
+
+        passed&=all(results.values())
+        print(f"consistency     Smoothing={Smoothing} {len(reference)} records: "
+              + ", ".join(f"{name} {'same' if result else 'DIFFERENT'}" for name, result in results.items()))
+
+    return passed
+
+
+
+def benchmark_aggregate(days=40, samples_per_day=48, chunksize=1000, min_coverage=0.5):
+
+    '''
+
+    daily_aggregate on a half-hourly CSV file, compared with the daily mean of pandas groupby on the whole file
+
+    The file has random values, a missing value written as -9999 and a day with less than min_coverage of its
+    values. chunksize is not a multiple of samples_per_day, so days are split over two chunks.
+
+    Returns
+    -------
+    passed : True if Var, n and gaps of every day are those of groupby, nan for the day with too few values
+
+    '''
+
+    rng=np.random.default_rng(3)
+    time_values=pd.date_range('2001-06-01', periods=days*samples_per_day, freq=f'{24*60//samples_per_day}min')
+    Var=rng.gamma(2.0, 3.0, size=len(time_values)).round(4)
+    Var[rng.choice(len(Var), size=len(Var)//50, replace=False)]=-9999
+    low=time_values.normalize()==time_values[0].normalize() + pd.Timedelta(days=days//2)
+    Var[np.flatnonzero(low)[:int(0.7*samples_per_day)]]=-9999
+    df_raw=pd.DataFrame({'TIMESTAMP_START': time_values.strftime('%Y%m%d%H%M'), 'GPP': Var})
+
+    with tempfile.TemporaryDirectory() as directory:
+        file=os.path.join(directory, 'halfhourly.csv')
+        df_raw.to_csv(file, index=False)
+        df_daily=ep.daily_aggregate(file, time='TIMESTAMP_START', Var='GPP', samples_per_day=samples_per_day,
+                                    min_coverage=min_coverage, chunksize=chunksize, time_format='%Y%m%d%H%M',
+                                    na_values=[-9999])
+
+    #the same days with pandas on the whole file
+    valid=df_raw['GPP'].where(df_raw['GPP']!=-9999)
+    grouped=valid.groupby(time_values.normalize())
+    mean, n=grouped.mean(), grouped.count()
+    mean[n<min_coverage*samples_per_day]=np.nan
+
+    passed=(len(df_daily)==days and bool((pd.DatetimeIndex(df_daily['time'])==mean.index).all())
+            and np.allclose(df_daily['Var'], mean, rtol=1e-12, atol=0, equal_nan=True)
+            and bool((df_daily['n']==n.to_numpy()).all()) and bool((df_daily['gaps']==samples_per_day-n.to_numpy()).all())
+            and bool(df_daily['Var'].isna().sum()==1))
+
+    print(f"aggregate       {days} days of {samples_per_day} values in chunks of {chunksize}: Var, n and gaps "
+          f"{'same as groupby' if passed else 'DIFFERENT from groupby'}, {df_daily['Var'].isna().sum()} day below coverage")
+
+    return passed
+
+
+
+def benchmark_uncertainty(n_replicates=40, chunk_size=10, seed=7):
+
+    '''
+
+    EasyPhenology_uncertainty on synthetic GPP, with the default options and with gap_fill 'climatology'
+
+    Returns
+    -------
+    passed : True if the estimate is the PTD of EasyPhenology with the same options and the intervals are the
+             same with n_jobs 1 and 2 for the same seed and chunk_size
+
+    '''
+
+    df=synthetic_gpp(start='2001-01-01', end='2010-12-31', seed=2).drop(columns='site')
+    methods={'threshold': ["SOS", "POS", "EOS", "GSL"], 'derivative': ["SOS_der", "POS", "EOS_der", "GSL_der"]}
+
+    passed=True
+    for Smoothing, options in (("True", {}), ("False", {}), ("True", {'gap_fill': 'climatology', 'max_missing': 120})):
+        runs=[ep.EasyPhenology_uncertainty(df, 0.5, Smoothing, 10, n_replicates=n_replicates, seed=seed, chunk_size=chunk_size,
+                                           n_jobs=n_jobs, **options) for n_jobs in (1, 2)]
+        single=ep.EasyPhenology(df, 0.5, Smoothing, 10, **options)[0]
+
+        #the estimate in the order of Year, Method and PTD of df_uncertainty
+        estimate=np.concatenate([np.column_stack([single[column].to_numpy(dtype=float) for column in columns])
+                                 for columns in methods.values()], axis=1).ravel()
+        same_estimate=np.array_equal(runs[0]['estimate'].to_numpy(dtype=float), estimate, equal_nan=True)
+        reproducible=runs[0].equals(runs[1])
+        passed&=same_estimate and reproducible
+
+        print(f"uncertainty     Smoothing={Smoothing} {options or 'default options'}: estimate "
+              f"{'same as EasyPhenology' if same_estimate else 'DIFFERENT from EasyPhenology'}, intervals "
+              f"{'same' if reproducible else 'DIFFERENT'} with n_jobs 1 and 2")
+
+    return passed
+
+
+
+def benchmark_golden_update():
+
+    '''
+
+    Stores the PTDs of the current EasyPhenology.py that differ from Data/golden_ptd.csv as the intended changes
+    in Data/golden_changes.csv. The reasons of the changes already listed are kept, new changes get the reason
+    "unexplained", to be replaced with the reason of the change. Data/golden_ptd.csv is not changed
+
+    '''
+
+    df_changes=golden_differences(golden_ptd())
+    if df_changes is None:
+        print(f"golden-update   the cases, years or errors differ from {os.path.relpath(golden_file, path)}, not stored")
+        return False
+
+    keys=['case', 'Smoothing', 'knots', 'Threshold', 'Year', 'PTD', 'golden', 'new']
+    df_intended=pd.read_csv(changes_file, dtype={'Smoothing': str}) if os.path.exists(changes_file) else pd.DataFrame(columns=keys+['reason'])
+    df_changes=df_changes.merge(df_intended, on=keys, how='left').fillna({'reason': 'unexplained'})
+    df_changes.to_csv(changes_file, index=False)
+
+    print(f"golden-update   stored {len(df_changes)} changes in {os.path.relpath(changes_file, path)}, "
+          f"{(df_changes['reason'] == 'unexplained').sum()} of them unexplained")
+
+    return True
+
+
+
+#Benchmarks by name, golden-update only runs if it is given
+benchmarks={'import': benchmark_import, 'scenarios': benchmark_scenarios, 'backends': benchmark_backends,
+            'golden': benchmark_golden, 'partial': benchmark_partial, 'seasons': benchmark_seasons,
+            'consistency': benchmark_consistency, 'aggregate': benchmark_aggregate,
+            'uncertainty': benchmark_uncertainty, 'golden-update': benchmark_golden_update}
+
+
+if __name__ == '__main__':
+
+    names=sys.argv[1:] or ['import', 'scenarios', 'backends', 'golden', 'partial', 'seasons', 'consistency', 'aggregate',
+                           'uncertainty']
+
+    failed=[name for name in names if not benchmarks[name]()]
+
+    if failed:
+        print("failed:", ", ".join(failed))
+        sys.exit(1)
@@ -1,4 +1,3 @@
-from turtle import onclick
 import pandas as pd  
 import matplotlib.pyplot as plt                                                                                                              
                                                                  
@@ -7,15 +6,16 @@ from EasyPhenology import EasyPhenology
                                                                
 if __name__ == '__main__':                                                       
     df = pd.read_pickle('Data/df_input.pkl')  # df_input is taken from site DE-THa Germany. df_input has columns in order time, year, doy, Var
-    df_smooth=  integral_smoothing(df)        #use function integral_smoothing(df) to get df_smooth with column Var smoothed values 
-                                              # Function EasyPhenology(df, Threshold_value) also give df_smooth, see below
-    df_pheno, df_smooth=  EasyPhenology(df, 0.5)    #Use EasyPhenology(df, Threshold_value) to get phenophases and smoothed Var value     
-                                                    #Here Threhold_value=0.5                         
+    df = df[(df.year>=1996) & (df.year<=2020)]  # the years with GPP, the other years are missing values only
+    df_smooth=  integral_smoothing(df, 10)    #use function integral_smoothing(df, knots) to get df_smooth with column Var smoothed values 
+                                              # Function EasyPhenology(df, Threshold_value, Smoothing, knots) also give df_smooth, see below
+    df_pheno, df_smooth=  EasyPhenology(df, 0.5, 'True', 10)    #Use EasyPhenology(df, Threshold_value, Smoothing, knots) to get phenophases and smoothed Var value     
+                                                                #Here Threhold_value=0.5, integral smoothing with 10 knots                         
 
     #Print the smoothed Var value                           
-    print(integral_smoothing(df))  
-    #Print the phenophaes and smoothed Var value                           
-    print(EasyPhenology(df, 0.5))
+    print(df_smooth)  
+    #Print the phenophaes                           
+    print(df_pheno)
 
 
     #Plot smoothed values and phenophases                          